@@ -11,7 +11,11 @@ from pyrogram import idle
 from WebStreamer.bot import StreamBot
 from WebStreamer.server import web_server
 from WebStreamer.utils import ping_server
+from WebStreamer.bot import multi_clients
 from WebStreamer.bot.clients import initialize_clients
+from WebStreamer.utils.database import Database
+from WebStreamer.utils.session_pool import warm_media_sessions, check_media_sessions
+from WebStreamer.utils.broadcast_helper import resume_broadcasts, broadcast_helpers
 
 
 logging.basicConfig(
@@ -48,8 +52,20 @@ async def start_services():
     StreamBot.fname=bot_info.first_name
     print("------------------------------ DONE ------------------------------")
     print()
+    db = Database(Var.DATABASE_URL, Var.SESSION_NAME)
+    if not Var.SECONDARY:
+        asyncio.create_task(db.create_indexes())
+        asyncio.create_task(db.backfill_metadata())
+    if Var.SEARCH_INDEX:
+        asyncio.create_task(db.build_search_index())
     print("---------------------- Initializing Clients ----------------------")
     await initialize_clients()
+    if Var.WARM_MEDIA_SESSIONS:
+        asyncio.create_task(warm_media_sessions(multi_clients))
+    if Var.SESSION_CHECK_INTERVAL:
+        asyncio.create_task(check_media_sessions(multi_clients))
+    if not Var.SECONDARY:
+        asyncio.create_task(resume_broadcasts(StreamBot, broadcast_helpers()))
     print("------------------------------ DONE ------------------------------")
     if Var.KEEP_ALIVE:
         print("------------------ Starting Keep Alive Service ------------------")
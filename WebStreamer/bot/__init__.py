@@ -3,6 +3,7 @@
 
 from ..vars import Var
 from pyrogram import Client
+from .scheduler import get_scheduler
 
 if Var.SECONDARY:
     plugins=None
@@ -25,3 +26,4 @@ StreamBot = Client(
 
 multi_clients = {}
 work_loads = {}
+scheduler = get_scheduler(Var.SCHEDULER, multi_clients, work_loads)
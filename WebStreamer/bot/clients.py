@@ -5,7 +5,7 @@ import logging
 from os import environ
 from ..vars import Var
 from pyrogram import Client
-from . import multi_clients, work_loads, StreamBot
+from . import multi_clients, work_loads, scheduler, StreamBot
 
 
 async def initialize_clients():
@@ -20,6 +20,7 @@ async def initialize_clients():
     if not all_tokens:
         multi_clients[0] = StreamBot
         work_loads[0] = 0
+        scheduler.set_dc(0, await StreamBot.storage.dc_id())
         print("No additional clients found, using default client")
         return
     
@@ -48,6 +49,7 @@ async def initialize_clients():
             ).start()
             client.id = (await client.get_me()).id
             work_loads[client_id] = 0
+            scheduler.set_dc(client_id, await client.storage.dc_id())
             return client_id, client
         except Exception:
             logging.error(f"Failed starting Client - {client_id} Error:", exc_info=True)
@@ -1,13 +1,9 @@
 # This file is a part of FileStreamBot
 
-import os
-import time
 import string
 import random
 import asyncio
-import aiofiles
-import datetime
-from WebStreamer.utils.broadcast_helper import send_msg
+from WebStreamer.utils.broadcast_helper import broadcasts, broadcast_helpers, cancel_broadcast, start_broadcast
 from WebStreamer.utils.database import Database
 from WebStreamer.bot import StreamBot
 from WebStreamer.utils.file_properties import get_media_from_message
@@ -16,7 +12,6 @@ from pyrogram import filters, Client
 from pyrogram.types import Message
 from pyrogram.enums.parse_mode import ParseMode
 db = Database(Var.DATABASE_URL, Var.SESSION_NAME)
-broadcast_ids = {}
 
 
 @StreamBot.on_message(filters.command("status") & filters.private & filters.user(Var.OWNER_ID))
@@ -74,72 +69,22 @@ async def sts(b, m: Message):
 
 @StreamBot.on_message(filters.command("broadcast") & filters.private & filters.user(Var.OWNER_ID) & filters.reply)
 async def broadcast_(c, m):
-    all_users = await db.get_all_users()
-    broadcast_msg = m.reply_to_message
     while True:
         broadcast_id = ''.join([random.choice(string.ascii_letters) for i in range(3)])
-        if not broadcast_ids.get(broadcast_id):
+        if not broadcasts.get(broadcast_id):
             break
-    out = await m.reply_text(
-        text=f"Broadcast initiated! You will be notified with log file when all the users are notified."
-    )
-    start_time = time.time()
-    total_users = await db.total_users_count()
-    done = 0
-    failed = 0
-    success = 0
-    broadcast_ids[broadcast_id] = dict(
-        total=total_users,
-        current=done,
-        failed=failed,
-        success=success
-    )
-    async with aiofiles.open('broadcast.txt', 'w') as broadcast_log_file:
-        async for user in all_users:
-            sts, msg = await send_msg(
-                user_id=int(user['id']),
-                message=broadcast_msg
-            )
-            if msg is not None:
-                await broadcast_log_file.write(msg)
-            if sts == 200:
-                success += 1
-            else:
-                failed += 1
-            if sts == 400:
-                await db.delete_user(user['id'])
-            done += 1
-            if broadcast_ids.get(broadcast_id) is None:
-                break
-            else:
-                broadcast_ids[broadcast_id].update(
-                    dict(
-                        current=done,
-                        failed=failed,
-                        success=success
-                    )
-                )
-                try:
-                    await out.edit_text(f"Broadcast Status\n\ncurrent: {done}\nfailed:{failed}\nsuccess: {success}")
-                except:
-                    pass
-    if broadcast_ids.get(broadcast_id):
-        broadcast_ids.pop(broadcast_id)
-    completed_in = datetime.timedelta(seconds=int(time.time() - start_time))
-    await asyncio.sleep(3)
-    await out.delete()
-    if failed == 0:
-        await m.reply_text(
-            text=f"broadcast completed in `{completed_in}`\n\nTotal users {total_users}.\nTotal done {done}, {success} success and {failed} failed.",
-            quote=True
-        )
+    # runs for as long as the broadcast lasts, don't hold a worker for it
+    asyncio.create_task(start_broadcast(broadcast_id, m.reply_to_message, StreamBot, broadcast_helpers()))
+
+@StreamBot.on_message(filters.command("cancel_broadcast") & filters.private & filters.user(Var.OWNER_ID))
+async def cancel_broadcast_(c, m: Message):
+    usr_cmd = m.text.split()
+    if len(usr_cmd) < 2:
+        return await m.reply_text("Invalid Format\n`/cancel_broadcast BroadcastID`")
+    if cancel_broadcast(usr_cmd[1]):
+        await m.reply_text(f"Cancelling broadcast `{usr_cmd[1]}`, you will get its log file shortly.")
     else:
-        await m.reply_document(
-            document='broadcast.txt',
-            caption=f"broadcast completed in `{completed_in}`\n\nTotal users {total_users}.\nTotal done {done}, {success} success and {failed} failed.",
-            quote=True
-        )
-    os.remove('broadcast.txt')
+        await m.reply_text(f"No running broadcast `{usr_cmd[1]}`")
 
 @StreamBot.on_message(filters.command("who") & filters.private & filters.user(Var.OWNER_ID) & filters.reply)
 async def sts(c: Client, m: Message):
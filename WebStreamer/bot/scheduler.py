@@ -0,0 +1,133 @@
+# This file is a part of FileStreamBot
+
+import time
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+ERROR_WINDOW = 60  # seconds an error counts against a client
+THROUGHPUT_ALPHA = 0.2  # weight of the newest sample in the throughput average
+DEFAULT_THROUGHPUT = 1024 * 1024  # bytes/s assumed for clients without samples
+DC_AFFINITY = 0.8  # score multiplier for clients whose home DC holds the file
+
+
+class ClientStats:
+    def __init__(self):
+        self.dc_id: Optional[int] = None
+        self.throughput: Optional[float] = None
+        self.errors: Deque[float] = deque(maxlen=32)
+        self.flood_until = 0.0
+        self.bytes = 0
+
+    def recent_errors(self, now: float) -> int:
+        while self.errors and self.errors[0] < now - ERROR_WINDOW:
+            self.errors.popleft()
+        return len(self.errors)
+
+
+class ClientScheduler:
+    def __init__(self, multi_clients: dict, work_loads: dict):
+        """Picks the client that serves a stream.
+        attributes:
+            multi_clients: the shared client index -> Client dict.
+            work_loads: the shared client index -> open streams dict.
+            stats: the measured ClientStats of each client index.
+
+        Subclasses only implement score(), lower is better. The streaming code reports
+        downloaded parts, errors and FloodWaits back through the record_* functions.
+        """
+        self.multi_clients = multi_clients
+        self.work_loads = work_loads
+        self.stats: Dict[int, ClientStats] = {}
+
+    def client_stats(self, index: int) -> ClientStats:
+        stats = self.stats.get(index)
+        if stats is None:
+            stats = self.stats[index] = ClientStats()
+        return stats
+
+    def score(self, index: int, dc_id: Optional[int], now: float) -> float:
+        raise NotImplementedError
+
+    def select_many(self, count: int, dc_id: Optional[int] = None) -> List[int]:
+        """
+        Returns up to count client indexes, best first.
+        """
+        now = time.time()
+        return sorted(self.work_loads, key=lambda i: self.score(i, dc_id, now))[:count]
+
+    def select(self, dc_id: Optional[int] = None) -> int:
+        return self.select_many(1, dc_id)[0]
+
+    def set_dc(self, index: int, dc_id: int) -> None:
+        self.client_stats(index).dc_id = dc_id
+
+    def record_chunk(self, index: int, size: int, seconds: float) -> None:
+        stats = self.client_stats(index)
+        stats.bytes += size
+        if not size or seconds <= 0:
+            return
+        rate = size / seconds
+        if stats.throughput is None:
+            stats.throughput = rate
+        else:
+            stats.throughput += THROUGHPUT_ALPHA * (rate - stats.throughput)
+
+    def record_error(self, index: int) -> None:
+        self.client_stats(index).errors.append(time.time())
+
+    def record_flood_wait(self, index: int, seconds: int) -> None:
+        stats = self.client_stats(index)
+        stats.flood_until = max(stats.flood_until, time.time() + seconds)
+        logging.warning(f"Client {index} got a FloodWait of {seconds}s")
+
+    def status(self) -> Dict[str, dict]:
+        now = time.time()
+        return {
+            f"bot{index + 1}": {
+                "dc_id": stats.dc_id,
+                "throughput": int(stats.throughput or 0),
+                "bytes": stats.bytes,
+                "recent_errors": stats.recent_errors(now),
+                "flood_wait": max(0, int(stats.flood_until - now)),
+            }
+            for index, stats in sorted(self.stats.items())
+        }
+
+
+class LeastLoadScheduler(ClientScheduler):
+    """Picks the client with the fewest open streams."""
+
+    def score(self, index: int, dc_id: Optional[int], now: float) -> float:
+        return self.work_loads[index]
+
+
+class ThroughputScheduler(ClientScheduler):
+    """Picks the client expected to serve one more stream the fastest.
+    The open streams are weighted by the measured bytes/s of the client, recent errors
+    make a client look slower, clients inside a FloodWait are only used when every
+    client is waiting, and clients living on the DC of the file are preferred."""
+
+    def score(self, index: int, dc_id: Optional[int], now: float) -> float:
+        stats = self.client_stats(index)
+        if stats.flood_until > now:
+            # sorts after every available client, earliest released first
+            return 1e12 + stats.flood_until
+        score = (self.work_loads[index] + 1) / (stats.throughput or DEFAULT_THROUGHPUT)
+        score *= 1 + 0.5 * stats.recent_errors(now)
+        if dc_id is not None and stats.dc_id == dc_id:
+            score *= DC_AFFINITY
+        return score
+
+
+SCHEDULERS = {
+    "least_load": LeastLoadScheduler,
+    "throughput": ThroughputScheduler,
+}
+
+
+def get_scheduler(name: str, multi_clients: dict, work_loads: dict) -> ClientScheduler:
+    if name not in SCHEDULERS:
+        logging.warning(f"Unknown scheduler {name}, using least_load")
+        name = "least_load"
+    return SCHEDULERS[name](multi_clients, work_loads)
@@ -0,0 +1,12 @@
+# This file is a part of FileStreamBot
+
+# Runs in the process pool of utils.title_parser. It must not import anything from the
+# app: a worker importing WebStreamer.utils would set up the clients, the database and
+# the caches of the whole bot.
+
+from typing import List
+import PTN
+
+
+def parse_many(titles: List[str]) -> List[dict]:
+    return [PTN.parse(title) for title in titles]
@@ -3,4 +3,15 @@ class InvalidHash(Exception):
     message = "Invalid hash"
 
 class FIleNotFound(Exception):
-    message = "File not found"
\ No newline at end of file
+    message = "File not found"
+
+class RangeNotSatisfiable(Exception):
+    message = "Range Not Satisfiable"
+
+
+class TooManyRequests(Exception):
+    message = "Too many downloads from your address, try again later"
+
+
+class ServerBusy(Exception):
+    message = "Server is busy, try again later"
@@ -0,0 +1,58 @@
+# This file is a part of FileStreamBot
+
+import re
+from typing import List, Optional, Tuple
+from WebStreamer.server.exceptions import RangeNotSatisfiable
+
+MAX_RANGES = 16  # more ranges than this (after merging) are answered with the whole file
+# ASCII only, str.isdigit() also accepts digits like "²" that int() can't parse
+RANGE_SPEC = re.compile(r"^(\d*)\s*-\s*(\d*)$", re.ASCII)
+
+
+def parse_range(header: str, file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses a Range header as in RFC 7233 into sorted, merged (start, end) pairs, ends included.
+    Returns None when the header must be ignored and the whole file served (other unit,
+    bad syntax, too many ranges), raises RangeNotSatisfiable when no range overlaps the file.
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs.strip():
+        return None
+
+    ranges = []
+    for spec in specs.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        match = RANGE_SPEC.match(spec)
+        if match is None or not (match[1] or match[2]):
+            return None
+        first, last = match.groups()
+        if not first:
+            # suffix range, the last n bytes
+            length = int(last)
+            if length == 0 or file_size == 0:
+                continue
+            ranges.append((max(0, file_size - length), file_size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= file_size:
+            continue
+        end = int(last) if last else file_size - 1
+        ranges.append((start, min(end, file_size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
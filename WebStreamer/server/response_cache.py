@@ -0,0 +1,34 @@
+# This file is a part of FileStreamBot
+
+import json
+from typing import Any, Awaitable, Callable, Hashable
+from aiohttp import web
+from WebStreamer.utils.lru_cache import TTLCache
+
+
+class ResponseCache:
+    def __init__(self, maxsize: int, ttl: float):
+        """Serialized JSON bodies of responses that only change with the file collection.
+        attributes:
+            cache: (generation, key) -> body bytes, entries also expire after ttl seconds.
+            generation: bumped by invalidate(), bodies built for an older generation are never served.
+
+        Concurrent misses of the same key share one build through TTLCache.get_or_load().
+        """
+        self.cache = TTLCache(maxsize, ttl)
+        self.generation = 0
+
+    def invalidate(self, *_) -> None:
+        # a build still running stores its body under the old generation, where nothing reads it
+        self.generation += 1
+        self.cache.clear()
+
+    async def json_response(self, key: Hashable, build: Callable[[], Awaitable[Any]]) -> web.Response:
+        async def serialize() -> bytes:
+            return json.dumps(await build()).encode()
+
+        body = await self.cache.get_or_load((self.generation, key), serialize)
+        return web.Response(body=body, content_type="application/json")
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), "generation": self.generation}
@@ -1,37 +1,51 @@
 import time
-import math
+import uuid
+import asyncio
 import logging
 import mimetypes
 import traceback
 import urllib.parse
 import re
-import PTN
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 
 from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
-from pymongo import MongoClient
-from bson.objectid import ObjectId
+from pyrogram.file_id import FileId
 
-from WebStreamer.bot import multi_clients, work_loads, StreamBot
+from WebStreamer.bot import multi_clients, work_loads, scheduler, StreamBot
 from WebStreamer.vars import Var
-from WebStreamer.server.exceptions import FIleNotFound, InvalidHash
+from WebStreamer.server.exceptions import FIleNotFound, InvalidHash, RangeNotSatisfiable, TooManyRequests, ServerBusy
+from WebStreamer.server.ranges import parse_range
+from WebStreamer.server.stream_writer import stream_registry, write_stream
+from WebStreamer.server.throttle import client_address, stream_limiter
+from WebStreamer.server.response_cache import ResponseCache
 from WebStreamer import utils, StartTime, __version__
 from WebStreamer.utils.render_template import render_page
-
-# ── MongoDB Setup ──
-import os
-from pymongo import MongoClient
-
-mongo_client = MongoClient(os.environ.get("DATABASE_URL"))
-
-db = mongo_client["F2LxBot"]
-videos = db["file"]
+from WebStreamer.utils.database import Database
+from WebStreamer.utils.search_index import search_index
+from WebStreamer.utils import title_parser
+from WebStreamer.utils.chunk_cache import disk_cache, hot_cache
+from WebStreamer.utils.custom_dl import file_id_cache
+from WebStreamer.utils.file_properties import file_records, get_file_record, store_container_index
+from WebStreamer.utils.container_index import build_index, pin_index_range, seek, faststart_plan, patch_moov, faststart_segments
+from WebStreamer.utils.lru_cache import TTLCache
+from WebStreamer.utils.metrics import CallbackMetric, render_metrics
+from WebStreamer.utils.session_pool import session_pools
+from WebStreamer.utils.range_planner import range_stats
 
 # ── Config ──
 import os
 
 FQDN = os.environ.get("FQDN", "localhost:8080")
 BASE_URL = f"https://{FQDN}/dl"
+MAX_PAGE_SIZE = 100
+CATALOG_CACHE_SIZE = 256  # cached /latest and /featured bodies
+
+db = Database(Var.DATABASE_URL, Var.SESSION_NAME)
+# dropped whenever a file is added or deleted, CATALOG_CACHE_TTL covers other processes
+catalog_cache = ResponseCache(CATALOG_CACHE_SIZE, Var.CATALOG_CACHE_TTL)
+Database.add_change_listener(catalog_cache.invalidate)
 
 
 def format_movie(doc):
@@ -40,37 +54,75 @@ def format_movie(doc):
         "url": f"{BASE_URL}/{doc['_id']}/{urllib.parse.quote(doc['file_name'])}"
     }
 
+def page_args(request, default_limit):
+    """Returns the (limit, cursor) of a catalog page request."""
+    try:
+        limit = int(request.query.get("limit", default_limit))
+    except ValueError:
+        raise web.HTTPBadRequest(text="limit must be a number")
+    return max(1, min(limit, MAX_PAGE_SIZE)), request.query.get("cursor") or None
+
+def catalog_page(docs, next_cursor):
+    return {"movies": [format_movie(doc) for doc in docs], "next_cursor": next_cursor}
+
+async def list_catalog_page(limit, cursor):
+    return catalog_page(*await db.list_catalog(limit, cursor))
+
 # ── Aiohttp App ──
 routes = web.RouteTableDef()
 
 @routes.get("/latest")
 async def latest(request):
-    doc = videos.find_one(sort=[("time", -1)])
-    if not doc:
-        return web.json_response({"_id": None, "time": 0})
-    return web.json_response({"_id": str(doc["_id"]), "time": doc["time"]})
+    async def build():
+        doc = await db.latest_file()
+        if not doc:
+            return {"_id": None, "time": 0}
+        return {"_id": str(doc["_id"]), "time": doc["time"]}
+    return await catalog_cache.json_response("latest", build)
 
 @routes.get("/featured")
 async def featured(request):
-    docs = videos.find().sort("time", -1).limit(10)
-    return web.json_response({"movies": [format_movie(doc) for doc in docs]})
+    limit, cursor = page_args(request, 10)
+    try:
+        return await catalog_cache.json_response(
+            ("featured", limit, cursor), lambda: list_catalog_page(limit, cursor)
+        )
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
 
 @routes.get("/search")
 async def search(request):
     q = request.query.get("q", "").strip()
     if not q:
-        return web.json_response({"movies": []})
-    regex = ".*".join(re.escape(w) for w in q.lower().split())
-    docs = videos.find({"file_name": {"$regex": regex, "$options": "i"}}).sort("time", -1).limit(30)
-    return web.json_response({"movies": [format_movie(doc) for doc in docs]})
+        return web.json_response({"movies": [], "next_cursor": None})
+    limit, cursor = page_args(request, 30)
+    try:
+        return web.json_response(catalog_page(*await db.search_catalog(q, limit, cursor)))
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+@routes.get("/episodes")
+async def episodes(request):
+    title = request.query.get("title", "").strip()
+    if not title:
+        return web.json_response({"error": "Missing ?title= parameter"}, status=400)
+    season = request.query.get("season")
+    if season is not None and not season.isdigit():
+        return web.json_response({"error": "season must be a number"}, status=400)
+    docs = await db.find_episodes(title, int(season) if season is not None else None)
+    return web.json_response({"episodes": [
+        {**format_movie(doc), "season": doc["meta"].get("season"), "episode": doc["meta"].get("episode")}
+        for doc in docs
+    ]})
 
 @routes.get("/play")
 async def play(request):
     vid = request.query.get("id")
     if not vid:
         return web.Response(text="Missing video ID", status=400)
-    doc = videos.find_one({"_id": ObjectId(vid)}) if ObjectId.is_valid(vid) else videos.find_one({"_id": vid})
-    if not doc:
+    try:
+        doc = await get_file_record(vid)
+    except FIleNotFound:
         return web.Response(text="Video not found", status=404)
     fname = doc["file_name"]
     return web.HTTPFound(location=f"{BASE_URL}/{doc['_id']}/{urllib.parse.quote(fname)}")
@@ -80,7 +132,28 @@ async def parse_handler(request):
     q = request.query.get("q")
     if not q:
         return web.json_response({"error": "Missing ?q= parameter"}, status=400)
-    return web.json_response(PTN.parse(q))
+    return web.json_response(await title_parser.parse_title(q))
+
+@routes.post("/parse")
+async def batch_parse_handler(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return web.json_response({"error": "Body must be JSON"}, status=400)
+    titles = body.get("titles") if isinstance(body, dict) else body
+    if not isinstance(titles, list) or not all(isinstance(t, str) for t in titles):
+        return web.json_response({"error": "Send a list of titles or {\"titles\": [...]}"}, status=400)
+    if len(titles) > Var.PARSE_MAX_BATCH:
+        return web.json_response({"error": f"At most {Var.PARSE_MAX_BATCH} titles per request"}, status=413)
+    start = time.perf_counter()
+    results = await title_parser.parse_titles(titles)
+    seconds = time.perf_counter() - start
+    return web.json_response({
+        "results": results,
+        "count": len(results),
+        "seconds": round(seconds, 4),
+        "titles_per_second": title_parser.titles_per_second(len(results), seconds),
+    })
 
 @routes.get("/status", allow_head=True)
 async def status_route_handler(_):
@@ -92,13 +165,63 @@ async def status_route_handler(_):
         "loads": {
             f"bot{c+1}": l for c, (_, l) in enumerate(sorted(work_loads.items(), key=lambda x: x[1], reverse=True))
         },
+        "cache": disk_cache.stats() if disk_cache else None,
+        "hot_cache": hot_cache.stats() if hot_cache else None,
+        "clients": scheduler.status(),
+        "file_cache": {
+            "records": file_records.stats(),
+            "file_ids": file_id_cache.stats(),
+        },
+        "streams": stream_registry.status(),
+        "limits": stream_limiter.status(),
+        "coalesced_parts": utils.ByteStreamer.coalesced_parts,
+        "refreshed_references": utils.ByteStreamer.refreshed_references,
+        "ranges": range_stats,
+        "catalog_cache": catalog_cache.stats(),
+        "search_index": search_index.stats(),
+        "parser": title_parser.stats(),
         "version": __version__,
     })
 
+# ── Metrics ──
+# counters kept by the streaming code anyway are only read when /metrics is scraped
+def cache_samples(attribute):
+    caches = {"hot": hot_cache, "disk": disk_cache, "records": file_records, "file_ids": file_id_cache}
+    return [((name,), getattr(cache, attribute)) for name, cache in caches.items() if cache is not None]
+
+CallbackMetric("filestream_cache_hits_total", "Cache hits per cache.", "counter", lambda: cache_samples("hits"), ("cache",))
+CallbackMetric("filestream_cache_misses_total", "Cache misses per cache.", "counter", lambda: cache_samples("misses"), ("cache",))
+CallbackMetric(
+    "filestream_active_streams", "Downloads being written.", "gauge",
+    lambda: [((), len(stream_registry.active))]
+)
+CallbackMetric(
+    "filestream_client_streams", "Open streams per client.", "gauge",
+    lambda: [((f"bot{i + 1}",), load) for i, load in sorted(work_loads.items())], ("client",)
+)
+CallbackMetric(
+    "filestream_media_sessions_created_total", "Media sessions created per client.", "counter",
+    lambda: [((f"bot{i + 1}",), session_pools[c].created) for i, c in sorted(multi_clients.items()) if c in session_pools],
+    ("client",)
+)
+CallbackMetric(
+    "filestream_range_bytes_total", "Bytes requested by clients, fetched with GetFile and fetched but not used.",
+    "counter", lambda: [((kind.replace("_bytes", ""),), value) for kind, value in range_stats.items()], ("kind",)
+)
+CallbackMetric(
+    "filestream_coalesced_parts_total", "Parts shared with a request already in flight.", "counter",
+    lambda: [((), utils.ByteStreamer.coalesced_parts)]
+)
+
+@routes.get("/metrics")
+async def metrics_route_handler(_):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
 @routes.get("/watch/{path}", allow_head=True)
 async def watch_route_handler(request):
     try:
         html = await render_page(request.match_info["path"])
+        schedule_container_index(request.match_info["path"])
         return web.Response(text=html, content_type="text/html")
     except InvalidHash as e:
         raise web.HTTPForbidden(text=e.message)
@@ -119,6 +242,10 @@ async def dl_route_handler(request):
         raise web.HTTPForbidden(text=e.message)
     except FIleNotFound as e:
         raise web.HTTPNotFound(text=e.message)
+    except TooManyRequests as e:
+        raise web.HTTPTooManyRequests(text=e.message, headers={"Retry-After": str(Var.RETRY_AFTER)})
+    except ServerBusy as e:
+        raise web.HTTPServiceUnavailable(text=e.message, headers={"Retry-After": str(Var.RETRY_AFTER)})
     except (AttributeError, BadStatusLine, ConnectionResetError):
         pass
     except Exception as e:
@@ -126,55 +253,282 @@ async def dl_route_handler(request):
         logging.debug(traceback.format_exc())
         raise web.HTTPInternalServerError(text=str(e))
 
-# ── Media Streaming Logic ──
-class_cache = {}
+@routes.get("/seek/{path}")
+async def seek_route_handler(request):
+    try:
+        seconds = float(request.query.get("t", "0"))
+    except ValueError:
+        raise web.HTTPBadRequest(text="t must be a number of seconds")
+    try:
+        index = await get_container_index(request.match_info["path"])
+    except FIleNotFound as e:
+        raise web.HTTPNotFound(text=e.message)
+    if not index or not index.get("format"):
+        return web.json_response({"error": "File is not an indexable MP4 or Matroska video"}, status=415)
+    keyframe, offset = seek(index, max(seconds, 0))
+    return web.json_response({
+        "format": index["format"],
+        "duration": index["duration"],
+        "time": keyframe,
+        "offset": offset,
+    })
 
-async def media_streamer(request, path, filename):
-    range_header = request.headers.get("Range", "")
-    idx = min(work_loads, key=work_loads.get)
-    client = multi_clients[idx]
-    if Var.MULTI_CLIENT:
-        logging.info(f"Client {idx} serving {request.remote}")
-    if client in class_cache:
-        conn = class_cache[client]
+# ── Container Index ──
+indexing = {}
+
+async def get_container_index(path):
+    """
+    Returns the container index of a file, parsing it the first time it's asked for.
+    Concurrent callers share one parse, failures aren't stored so a later call retries.
+    """
+    record = await get_file_record(path)
+    index = record.get("container_index")
+    if index is not None:
+        pin_index_range(index, record["file_unique_id"])
+        return index
+    task = indexing.get(path)
+    if task is None:
+        task = indexing[path] = asyncio.ensure_future(build_container_index(path, record))
+        task.add_done_callback(lambda _: indexing.pop(path, None))
+    return await asyncio.shield(task)
+
+async def build_container_index(path, record):
+    if not (record.get("mime_type") or "").startswith("video/"):
+        index = {"format": None}
     else:
-        conn = utils.ByteStreamer(client)
-        class_cache[client] = conn
+        try:
+            conn = get_streamer(scheduler.select(FileId.decode(record["file_id"]).dc_id))
+            file_id = await conn.get_file_properties(path, multi_clients)
+            read = lambda offset, length: conn.read_bytes(file_id, offset, length)
+            index = await build_index(read, file_id.file_size, file_id.unique_id)
+        except Exception:
+            logging.warning(f"Failed indexing the container of {path}", exc_info=True)
+            return None
+    logging.info(f"Indexed container of {path}: {index.get('format')}, {len(index.get('keyframes', []))} keyframes")
+    await store_container_index(path, index)
+    return index
+
+def schedule_container_index(path):
+    """Starts indexing a file in the background, the player asks for its seek points soon."""
+    record = file_records.peek(str(path))
+    if path not in indexing and (record is None or "container_index" not in record):
+        asyncio.ensure_future(get_container_index(path)).add_done_callback(
+            lambda f: f.cancelled() or f.exception()
+        )
 
+# ── Virtual Faststart ──
+FASTSTART_CACHE_SIZE = 32  # patched moov atoms kept in memory
+FASTSTART_CACHE_BYTES = 128 * 1024 * 1024  # their total size, a moov can be up to MAX_INDEX_SIZE
+faststart_moovs = TTLCache(
+    FASTSTART_CACHE_SIZE, Var.FILE_CACHE_TTL, FASTSTART_CACHE_BYTES, lambda moov: len(moov) if moov else 0
+)
+
+def wants_faststart(request):
+    return request.query.get("faststart", "").lower() in ("1", "true", "yes")
+
+async def get_faststart_layout(path, record):
+    """
+    Returns the virtual layout serving the moov of the file first, None when the file
+    already starts with it, isn't an MP4 or can't be remapped.
+    """
+    try:
+        index = await get_container_index(path)
+        plan = faststart_plan(index) if index else None
+        if plan is None:
+            return None
+        moov = await faststart_moovs.get_or_load(record["file_unique_id"], lambda: load_patched_moov(path, record, *plan))
+    except Exception:
+        logging.warning(f"Failed building the faststart layout of {path}", exc_info=True)
+        return None
+    return faststart_segments(plan[0], plan[1], moov, record["file_size"]) if moov else None
+
+def cached_faststart_layout(record):
+    """The faststart layout if its index and moov are already cached, HEAD requests never fetch them."""
+    index = record.get("container_index")
+    plan = faststart_plan(index) if index else None
+    moov = faststart_moovs.peek(record["file_unique_id"]) if plan else None
+    return faststart_segments(plan[0], plan[1], moov, record["file_size"]) if moov else None
+
+async def load_patched_moov(path, record, head_end, moov_offset, moov_size):
+    conn = get_streamer(scheduler.select(FileId.decode(record["file_id"]).dc_id))
     file_id = await conn.get_file_properties(path, multi_clients)
-    file_size = file_id.file_size
+    return patch_moov(await conn.read_bytes(file_id, moov_offset, moov_size), head_end, moov_offset)
 
-    if range_header:
-        try:
-            parts = range_header.replace("bytes=", "").split("-")
-            from_b = int(parts[0]) if parts[0] else 0
-            to_b = int(parts[1]) if len(parts) > 1 and parts[1] else file_size - 1
-        except (IndexError, ValueError):
-            from_b, to_b = 0, file_size - 1
-    else:
-        from_b, to_b = 0, file_size - 1
+# ── Media Streaming Logic ──
+class_cache = {}
 
-    if to_b > file_size or from_b < 0 or to_b < from_b:
-        return web.Response(status=416, text="Range Not Satisfiable", headers={"Content-Range": f"bytes */{file_size}"})
+def get_streamer(index):
+    client = multi_clients[index]
+    if client in class_cache:
+        return class_cache[client]
+    conn = utils.ByteStreamer(client, index)
+    class_cache[client] = conn
+    return conn
+
+def get_validators(record):
+    """Returns the strong ETag and the Last-Modified time of a stored file."""
+    etag = f'"{record["file_unique_id"]}"'
+    added = record.get("time")
+    last_modified = datetime.fromtimestamp(int(added), timezone.utc) if isinstance(added, (int, float)) else None
+    return etag, last_modified
+
+def etag_matches(header, etag, weak=True):
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if weak and tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+def is_not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    since = request.if_modified_since
+    return since is not None and last_modified is not None and last_modified <= since
+
+def if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get("If-Range")
+    if if_range is None:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return etag_matches(if_range, etag, weak=False)
+    try:
+        return last_modified is not None and last_modified == parsedate_to_datetime(if_range)
+    except (TypeError, ValueError):
+        return False
+
+async def media_streamer(request, path, filename):
+    # everything up to the body is answered from the stored file record
+    record = await get_file_record(path)
+    file_size = record["file_size"]
+    etag, last_modified = get_validators(record)
+    if not wants_faststart(request):
+        layout = None
+    elif request.method == "HEAD":
+        layout = cached_faststart_layout(record)
+    else:
+        layout = await get_faststart_layout(path, record)
+    if layout is not None:
+        # a different byte layout is a different representation
+        etag = f'"{record["file_unique_id"]}-faststart"'
+    validators = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={Var.CACHE_MAX_AGE}",
+        "Accept-Ranges": "bytes",
+    }
+    if last_modified is not None:
+        validators["Last-Modified"] = format_datetime(last_modified, usegmt=True)
 
-    chunk = 1024 * 1024
-    offset = from_b - (from_b % chunk)
-    first_cut = from_b - offset
-    last_cut = to_b % chunk + 1
-    length = to_b - from_b + 1
-    parts_count = math.ceil(to_b / chunk) - math.floor(offset / chunk)
+    if is_not_modified(request, etag, last_modified):
+        return web.Response(status=304, headers=validators)
 
-    body = conn.yield_file(file_id, idx, offset, first_cut, last_cut, parts_count, chunk)
-    ctype = file_id.mime_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    ranges = None
+    range_header = request.headers.get("Range", "")
+    if range_header and if_range_matches(request, etag, last_modified):
+        try:
+            ranges = parse_range(range_header, file_size)
+        except RangeNotSatisfiable as e:
+            return web.Response(status=416, text=e.message, headers={**validators, "Content-Range": f"bytes */{file_size}"})
 
+    ctype = record.get("mime_type") or mimetypes.guess_type(filename)[0] or "application/octet-stream"
     headers = {
-        "Content-Type": ctype,
-        "Content-Range": f"bytes {from_b}-{to_b}/{file_size}",
-        "Content-Length": str(length),
+        **validators,
         "Content-Disposition": f'attachment; filename="{filename}"',
-        "Accept-Ranges": "bytes",
     }
-    return web.Response(status=206 if range_header else 200, body=body, headers=headers)
+    if ranges is None:
+        status = 200
+        ranges = [(0, file_size - 1)]
+        headers["Content-Type"] = ctype
+        headers["Content-Length"] = str(file_size)
+    elif len(ranges) == 1:
+        status = 206
+        from_b, to_b = ranges[0]
+        headers["Content-Type"] = ctype
+        headers["Content-Range"] = f"bytes {from_b}-{to_b}/{file_size}"
+        headers["Content-Length"] = str(to_b - from_b + 1)
+    else:
+        status = 206
+        boundary = uuid.uuid4().hex
+        part_headers = [
+            f"--{boundary}\r\nContent-Type: {ctype}\r\nContent-Range: bytes {from_b}-{to_b}/{file_size}\r\n\r\n".encode()
+            for from_b, to_b in ranges
+        ]
+        closing = f"--{boundary}--\r\n".encode()
+        headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["Content-Length"] = str(
+            sum(len(h) + to_b - from_b + 1 + 2 for h, (from_b, to_b) in zip(part_headers, ranges)) + len(closing)
+        )
+    if request.method == "HEAD" or not file_size:
+        return web.Response(status=status, headers=headers)
+
+    remote = client_address(request)
+    slot = stream_limiter.acquire(remote, path)
+    try:
+        idx = scheduler.select(FileId.decode(record["file_id"]).dc_id)
+        if Var.MULTI_CLIENT:
+            logging.info(f"Client {idx} serving {remote}")
+        conn = get_streamer(idx)
+
+        file_id = await conn.get_file_properties(path, multi_clients)
+
+        if len(ranges) == 1:
+            body = await range_body(request, conn, file_id, idx, path, *ranges[0], layout=layout)
+        else:
+            body = multipart_body(request, conn, file_id, idx, path, ranges, part_headers, closing, layout)
+        response = web.StreamResponse(status=status, headers=headers)
+        await write_stream(request, response, body, stream_registry.open(remote, path), slot)
+        return response
+    finally:
+        slot.release()
+
+async def range_body(request, conn, file_id, idx, path, from_b, to_b, layout=None):
+    """Returns the generator yielding the bytes from_b..to_b (ends included) of the file."""
+    if layout is not None:
+        return layout_body(request, conn, file_id, idx, path, layout, from_b, to_b)
+    offset, first_cut, last_cut, parts_count, chunk = conn.plan(file_id, from_b, to_b)
+
+    stripes = min(Var.STRIPE_CLIENTS, len(multi_clients))
+    if Var.MULTI_CLIENT and stripes > 1 and to_b - from_b + 1 >= Var.STRIPE_MIN_SIZE and parts_count > 1:
+        others = [i for i in scheduler.select_many(stripes, file_id.dc_id) if i != idx][:stripes - 1]
+        other_conns = [get_streamer(i) for i in others]
+        other_ids = await asyncio.gather(*(c.get_file_properties(path, multi_clients) for c in other_conns))
+        streams = [(conn, file_id, idx)] + list(zip(other_conns, other_ids, others))
+        logging.info(f"Striping {request.remote} over clients {[i for _, _, i in streams]}")
+        return utils.ByteStreamer.yield_file_striped(streams, offset, first_cut, last_cut, parts_count, chunk)
+    return conn.yield_file(file_id, idx, offset, first_cut, last_cut, parts_count, chunk)
+
+async def layout_body(request, conn, file_id, idx, path, layout, from_b, to_b):
+    """Yields the bytes from_b..to_b of a virtual layout, mapped back to the original offsets."""
+    for start, length, source in layout:
+        lo, hi = max(from_b, start), min(to_b, start + length - 1)
+        if lo > hi:
+            continue
+        if isinstance(source, bytes):
+            yield source[lo - start:hi - start + 1]
+            continue
+        body = await range_body(request, conn, file_id, idx, path, source + lo - start, source + hi - start)
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            await body.aclose()
+
+async def multipart_body(request, conn, file_id, idx, path, ranges, part_headers, closing, layout=None):
+    """Yields a multipart/byteranges body, each part is fed from the chunk pipeline."""
+    for part_header, (from_b, to_b) in zip(part_headers, ranges):
+        yield part_header
+        body = await range_body(request, conn, file_id, idx, path, from_b, to_b, layout)
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            await body.aclose()
+        yield b"\r\n"
+    yield closing
 
 import asyncio
 import subprocess
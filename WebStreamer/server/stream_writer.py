@@ -0,0 +1,124 @@
+# This file is a part of FileStreamBot
+
+import time
+import logging
+from itertools import count
+from typing import AsyncGenerator, Dict, Optional
+from aiohttp import web
+from WebStreamer.vars import Var
+from WebStreamer.server.throttle import StreamSlot
+from WebStreamer.utils.metrics import SENT_BYTES, STREAMS, TTFB_SECONDS
+
+STALL_THRESHOLD = 0.05  # seconds a write may take before it counts as a stall
+
+
+class StreamStats:
+    __slots__ = ("id", "remote", "path", "started", "first_byte", "bytes_sent", "stall_time", "finished")
+
+    def __init__(self, stream_id: int, remote: str, path: str):
+        self.id = stream_id
+        self.remote = remote
+        self.path = path
+        self.started = time.monotonic()
+        self.first_byte = None
+        self.bytes_sent = 0
+        self.stall_time = 0.0
+        self.finished = None
+
+    @property
+    def duration(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def as_dict(self) -> dict:
+        return {
+            "remote": self.remote,
+            "path": self.path,
+            "bytes_sent": self.bytes_sent,
+            "duration": round(self.duration, 3),
+            "stall_time": round(self.stall_time, 3),
+        }
+
+
+class StreamRegistry:
+    def __init__(self):
+        """Keeps the accounting of every download served by this process.
+        attributes:
+            active: the StreamStats of the open streams by id.
+            totals: counters summed over every finished stream.
+        """
+        self._ids = count(1)
+        self.active: Dict[int, StreamStats] = {}
+        self.totals = {
+            "streams": 0,
+            "completed": 0,
+            "aborted": 0,
+            "bytes_sent": 0,
+            "duration": 0.0,
+            "stall_time": 0.0,
+        }
+
+    def open(self, remote: str, path: str) -> StreamStats:
+        stats = StreamStats(next(self._ids), remote, path)
+        self.active[stats.id] = stats
+        return stats
+
+    def close(self, stats: StreamStats, completed: bool) -> None:
+        stats.finished = time.monotonic()
+        (COMPLETED if completed else ABORTED).inc()
+        self.active.pop(stats.id, None)
+        self.totals["streams"] += 1
+        self.totals["completed" if completed else "aborted"] += 1
+        self.totals["bytes_sent"] += stats.bytes_sent
+        self.totals["duration"] += stats.duration
+        self.totals["stall_time"] += stats.stall_time
+
+    def status(self) -> dict:
+        return {
+            "active": len(self.active),
+            "active_bytes_sent": sum(s.bytes_sent for s in self.active.values()),
+            **{k: round(v, 3) if isinstance(v, float) else v for k, v in self.totals.items()},
+        }
+
+
+stream_registry = StreamRegistry()
+COMPLETED = STREAMS.labels("completed")
+ABORTED = STREAMS.labels("aborted")
+
+
+async def write_stream(
+    request: web.Request,
+    response: web.StreamResponse,
+    body: AsyncGenerator[bytes, None],
+    stats: StreamStats,
+    slot: Optional[StreamSlot] = None,
+) -> None:
+    """
+    Writes the body to the client one part at a time. Every write waits for the socket
+    to drain below STREAM_BUFFER_SIZE, so a slow reader stops the body from being
+    advanced instead of piling parts up in memory. When a slot is given, each part
+    also waits for its bandwidth tokens.
+    """
+    completed = False
+    try:
+        if request.transport is not None:
+            request.transport.set_write_buffer_limits(high=Var.STREAM_BUFFER_SIZE)
+        await response.prepare(request)
+        async for chunk in body:
+            if slot is not None:
+                await slot.consume(len(chunk))
+            start = time.monotonic()
+            await response.write(chunk)
+            elapsed = time.monotonic() - start
+            if stats.first_byte is None:
+                stats.first_byte = start - stats.started
+                TTFB_SECONDS.observe(stats.first_byte)
+            if elapsed > STALL_THRESHOLD:
+                stats.stall_time += elapsed
+            stats.bytes_sent += len(chunk)
+            SENT_BYTES.inc(len(chunk))
+        await response.write_eof()
+        completed = True
+    finally:
+        await body.aclose()
+        stream_registry.close(stats, completed)
+        logging.debug(f"Stream {stats.id} to {stats.remote} closed: {stats.as_dict()}")
@@ -0,0 +1,140 @@
+# This file is a part of FileStreamBot
+
+import time
+import asyncio
+from typing import Dict
+from collections import defaultdict
+from WebStreamer.vars import Var
+from WebStreamer.server.exceptions import TooManyRequests, ServerBusy
+
+
+def client_address(request) -> str:
+    """
+    The address a request came from. With TRUSTED_PROXIES hops, the rightmost address of
+    X-Forwarded-For that none of the trusted proxies added, the earlier ones are client supplied.
+    """
+    if not Var.TRUSTED_PROXIES:
+        return request.remote
+    forwarded = [
+        address.strip()
+        for header in request.headers.getall("X-Forwarded-For", [])
+        for address in header.split(",")
+        if address.strip()
+    ]
+    hops = forwarded + [request.remote]
+    return hops[max(0, len(hops) - 1 - Var.TRUSTED_PROXIES)]
+
+
+class TokenBucket:
+    def __init__(self, rate: float):
+        """Bytes/s limiter where a caller reserves tokens up front and sleeps off the debt,
+        so concurrent callers of one bucket are served in arrival order."""
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: int) -> float:
+        """
+        Takes amount tokens and returns the seconds to wait before using them.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class StreamSlot:
+    def __init__(self, limiter: "StreamLimiter", ip: str, file: str):
+        self.limiter = limiter
+        self.ip = ip
+        self.file = file
+        self.released = False
+
+    async def consume(self, amount: int) -> None:
+        delay = self.limiter.reserve(self.ip, self.file, amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.limiter.release(self.ip, self.file)
+
+
+class StreamLimiter:
+    def __init__(self):
+        """Limits the open streams and their bytes/s per remote address, per file and globally.
+        attributes:
+            ip_streams / file_streams: open streams by remote address / file.
+            ip_buckets / file_buckets: TokenBuckets of the addresses / files with open streams.
+
+        The global RATE_LIMIT is shared equally between the addresses with open streams, so
+        an address opening many parallel ranges doesn't take bandwidth from everyone else.
+        """
+        self.streams = 0
+        self.ip_streams: Dict[str, int] = defaultdict(int)
+        self.file_streams: Dict[str, int] = defaultdict(int)
+        self.ip_buckets: Dict[str, TokenBucket] = {}
+        self.file_buckets: Dict[str, TokenBucket] = {}
+        self.rejected = 0
+
+    def acquire(self, ip: str, file: str) -> StreamSlot:
+        """
+        Opens a stream slot, raises TooManyRequests or ServerBusy when a limit is reached.
+        """
+        if Var.MAX_STREAMS_PER_IP and self.ip_streams[ip] >= Var.MAX_STREAMS_PER_IP:
+            self.rejected += 1
+            raise TooManyRequests
+        if (Var.MAX_STREAMS and self.streams >= Var.MAX_STREAMS) or (
+            Var.MAX_STREAMS_PER_FILE and self.file_streams[file] >= Var.MAX_STREAMS_PER_FILE
+        ):
+            self.rejected += 1
+            raise ServerBusy
+        self.streams += 1
+        self.ip_streams[ip] += 1
+        self.file_streams[file] += 1
+        return StreamSlot(self, ip, file)
+
+    def release(self, ip: str, file: str) -> None:
+        self.streams -= 1
+        self.ip_streams[ip] -= 1
+        if self.ip_streams[ip] <= 0:
+            del self.ip_streams[ip]
+            self.ip_buckets.pop(ip, None)
+        self.file_streams[file] -= 1
+        if self.file_streams[file] <= 0:
+            del self.file_streams[file]
+            self.file_buckets.pop(file, None)
+
+    def ip_rate(self) -> float:
+        rates = [Var.RATE_LIMIT_PER_IP]
+        if Var.RATE_LIMIT:
+            rates.append(Var.RATE_LIMIT / max(1, len(self.ip_streams)))
+        return min(rate for rate in rates if rate)
+
+    def reserve(self, ip: str, file: str, amount: int) -> float:
+        delay = 0.0
+        if Var.RATE_LIMIT or Var.RATE_LIMIT_PER_IP:
+            bucket = self.ip_buckets.get(ip)
+            if bucket is None:
+                bucket = self.ip_buckets[ip] = TokenBucket(self.ip_rate())
+            bucket.rate = self.ip_rate()
+            delay = bucket.reserve(amount)
+        if Var.RATE_LIMIT_PER_FILE:
+            bucket = self.file_buckets.get(file)
+            if bucket is None:
+                bucket = self.file_buckets[file] = TokenBucket(Var.RATE_LIMIT_PER_FILE)
+            delay = max(delay, bucket.reserve(amount))
+        return delay
+
+    def status(self) -> dict:
+        return {
+            "streams": self.streams,
+            "addresses": len(self.ip_streams),
+            "files": len(self.file_streams),
+            "rejected": self.rejected,
+        }
+
+
+stream_limiter = StreamLimiter()
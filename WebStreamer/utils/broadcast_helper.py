@@ -1,22 +1,233 @@
 # This file is a part of FileStreamBot
 
+import os
+import time
 import asyncio
+import logging
+import aiofiles
+import datetime
 import traceback
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from pyrogram import Client
 from pyrogram.errors import FloodWait, InputUserDeactivated, UserIsBlocked, PeerIdInvalid
+from WebStreamer.vars import Var
+from WebStreamer.bot import StreamBot, multi_clients
+from WebStreamer.server.throttle import TokenBucket
+from WebStreamer.utils.database import Database
 
+db = Database(Var.DATABASE_URL, Var.SESSION_NAME)
+# running broadcasts by id
+broadcasts: Dict[str, "Broadcast"] = {}
 
-async def send_msg(user_id, message):
-    try:
-        await message.copy(chat_id=user_id)
-        return 200, None
-    except FloodWait as e:
-        await asyncio.sleep(e.value)
-        return send_msg(user_id, message)
-    except InputUserDeactivated:
-        return 400, f"{user_id} : deactivated\n"
-    except UserIsBlocked:
-        return 400, f"{user_id} : blocked the bot\n"
-    except PeerIdInvalid:
-        return 400, f"{user_id} : user id invalid\n"
-    except Exception as e:
-        return 500, f"{user_id} : {traceback.format_exc()}\n"
+
+class Sender:
+    def __init__(self, client: Client, rate: float):
+        """A client sending broadcast messages at most rate messages/s.
+        A FloodWait puts the whole bucket in debt, so every worker of the client waits."""
+        self.client = client
+        self.bucket = TokenBucket(rate)
+
+    async def copy(self, user_id: int, message_id: int) -> Tuple[int, Optional[str]]:
+        while True:
+            delay = self.bucket.reserve(1)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.client.copy_message(chat_id=user_id, from_chat_id=Var.BIN_CHANNEL, message_id=message_id)
+                return 200, None
+            except FloodWait as e:
+                self.bucket.tokens = min(self.bucket.tokens, -e.value * self.bucket.rate)
+            except InputUserDeactivated:
+                return 400, f"{user_id} : deactivated\n"
+            except UserIsBlocked:
+                return 400, f"{user_id} : blocked the bot\n"
+            except PeerIdInvalid:
+                return 400, f"{user_id} : user id invalid\n"
+            except Exception:
+                return 500, f"{user_id} : {traceback.format_exc()}\n"
+
+
+class Broadcast:
+    def __init__(self, state: dict, main: Client, helpers: List[Client]):
+        """Sends a message stored in BIN_CHANNEL to every user, resumable after a restart.
+        attributes:
+            state: the checkpoint document stored in the broadcasts collection.
+            main: StreamBot, the bot every user started.
+            senders: the Sender of StreamBot first, then of the helper clients.
+            dispatched / finished: user ids handed to the workers in order and the outcome
+                of the ones done. The checkpoint only moves past users whose predecessors are
+                all done and counts them as it does, so the stored counters always match
+                state["last_user_id"] and a resumed broadcast counts nobody twice.
+
+        Users are streamed from a cursor ordered by id, starting after state["last_user_id"].
+        Helper clients can only message users who started them, so a user one of them
+        can't reach is retried through StreamBot before being counted as failed.
+        """
+        self.state = state
+        self.main = Sender(main, Var.BROADCAST_RATE)
+        self.senders = [self.main] + [Sender(client, Var.BROADCAST_RATE) for client in helpers]
+        self.dispatched: Deque[int] = deque()
+        self.finished: Dict[int, int] = {}
+        self.cancelled = False
+        self.log_path = f"broadcast_{state['_id']}.txt"
+
+    @property
+    def id(self) -> str:
+        return self.state["_id"]
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+    async def run(self) -> None:
+        broadcasts[self.id] = self
+        queue: asyncio.Queue = asyncio.Queue(maxsize=Var.BROADCAST_WORKERS * 2)
+        workers = [
+            asyncio.create_task(self.worker(self.senders[i % len(self.senders)], queue))
+            for i in range(Var.BROADCAST_WORKERS)
+        ]
+        reporter = asyncio.create_task(self.report())
+        try:
+            async for user in db.users_after(self.state["last_user_id"]):
+                if self.cancelled:
+                    break
+                self.dispatched.append(user["id"])
+                await queue.put(user["id"])
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            reporter.cancel()
+            broadcasts.pop(self.id, None)
+        self.state["status"] = "cancelled" if self.cancelled else "done"
+        await self.checkpoint()
+        await self.finish()
+
+    async def worker(self, sender: Sender, queue: asyncio.Queue) -> None:
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            if self.cancelled:
+                continue
+            sts, msg = await sender.copy(user_id, self.state["message_id"])
+            if sts == 400 and sender is not self.main:
+                sts, msg = await self.main.copy(user_id, self.state["message_id"])
+            if msg is not None:
+                async with aiofiles.open(self.log_path, "a") as broadcast_log_file:
+                    await broadcast_log_file.write(msg)
+            if sts == 400:
+                await db.delete_user(user_id)
+            self.finished[user_id] = sts
+
+    def advance(self) -> None:
+        while self.dispatched and self.dispatched[0] in self.finished:
+            user_id = self.dispatched.popleft()
+            sts = self.finished.pop(user_id)
+            self.state["done"] += 1
+            self.state["success" if sts == 200 else "failed"] += 1
+            self.state["last_user_id"] = user_id
+
+    async def checkpoint(self) -> None:
+        self.advance()
+        await db.save_broadcast(self.state)
+
+    def status_text(self) -> str:
+        pending = list(self.finished.values())
+        success = self.state["success"] + pending.count(200)
+        failed = self.state["failed"] + len(pending) - pending.count(200)
+        return (
+            f"Broadcast Status\n\ncurrent: {self.state['done'] + len(pending)}/{self.state['total']}"
+            f"\nfailed:{failed}\nsuccess: {success}"
+        )
+
+    async def report(self) -> None:
+        """Edits the progress message and saves the checkpoint every BROADCAST_PROGRESS_INTERVAL."""
+        last_text = None
+        while True:
+            await asyncio.sleep(Var.BROADCAST_PROGRESS_INTERVAL)
+            await self.checkpoint()
+            text = self.status_text()
+            if text != last_text:
+                try:
+                    await self.main.client.edit_message_text(
+                        self.state["chat_id"], self.state["progress_message_id"], text
+                    )
+                    last_text = text
+                except Exception:
+                    logging.debug(f"Failed editing progress of broadcast {self.id}", exc_info=True)
+
+    async def finish(self) -> None:
+        client = self.main.client
+        completed_in = datetime.timedelta(seconds=int(time.time() - self.state["started"]))
+        text = (
+            f"broadcast {self.state['status']} in `{completed_in}`\n\nTotal users {self.state['total']}.\n"
+            f"Total done {self.state['done']}, {self.state['success']} success and {self.state['failed']} failed."
+        )
+        try:
+            await client.delete_messages(self.state["chat_id"], self.state["progress_message_id"])
+        except Exception:
+            pass
+        if os.path.exists(self.log_path):
+            await client.send_document(self.state["chat_id"], self.log_path, caption=text)
+            os.remove(self.log_path)
+        else:
+            await client.send_message(self.state["chat_id"], text)
+
+
+def broadcast_helpers() -> List[Client]:
+    """The multi clients sharing the broadcast with StreamBot when BROADCAST_MULTI_CLIENT is set."""
+    if not Var.BROADCAST_MULTI_CLIENT:
+        return []
+    return [client for client in multi_clients.values() if client is not StreamBot]
+
+
+async def start_broadcast(broadcast_id: str, message, main: Client, helpers: List[Client]) -> None:
+    """
+    Copies the message to BIN_CHANNEL, where every client can read it, and broadcasts it.
+    """
+    stored = await message.copy(chat_id=Var.BIN_CHANNEL)
+    out = await message.reply_text(
+        text="Broadcast initiated! You will be notified with log file when all the users are notified.\n"
+             f"Send `/cancel_broadcast {broadcast_id}` to stop it."
+    )
+    state = {
+        "_id": broadcast_id,
+        "message_id": stored.id,
+        "chat_id": message.chat.id,
+        "progress_message_id": out.id,
+        "last_user_id": None,
+        "total": await db.total_users_count(),
+        "done": 0,
+        "success": 0,
+        "failed": 0,
+        "started": time.time(),
+        "status": "running",
+    }
+    await db.save_broadcast(state)
+    await Broadcast(state, main, helpers).run()
+
+
+def cancel_broadcast(broadcast_id: str) -> bool:
+    """Stops a running broadcast after the messages being sent, returns False if there is none."""
+    broadcast = broadcasts.get(broadcast_id)
+    if broadcast is None:
+        return False
+    broadcast.cancel()
+    return True
+
+
+async def resume_broadcasts(main: Client, helpers: List[Client]) -> None:
+    """
+    Continues the broadcasts a restart interrupted from their last checkpoint.
+    """
+    for state in await db.get_running_broadcasts():
+        logging.info(f"Resuming broadcast {state['_id']} after user {state['last_user_id']}")
+        try:
+            out = await main.send_message(state["chat_id"], "Broadcast resumed after a restart.")
+            state["progress_message_id"] = out.id
+        except Exception:
+            logging.warning(f"Failed announcing the resumed broadcast {state['_id']}", exc_info=True)
+        asyncio.create_task(Broadcast(state, main, helpers).run())
@@ -0,0 +1,230 @@
+# This file is a part of FileStreamBot
+
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Optional
+from collections import OrderedDict
+from WebStreamer.vars import Var
+
+CHUNK_SIZE = 1024 * 1024
+MAX_PINNED_FILES = 1024  # files whose container index parts stay admitted
+STALE_TMP_AGE = 3600  # seconds after which a temporary part of another process is left over from a crash
+
+
+class DiskChunkCache:
+    def __init__(self, path: str, max_size: int):
+        """A LRU cache of 1 MiB aligned file parts stored on disk.
+        attributes:
+            path: the directory holding the cached parts.
+            max_size: the byte budget of the cache.
+            entries: the cached part names in LRU order with their size.
+
+        Parts are named `<file_unique_id>_<part index>` and written to a temporary
+        file before being renamed, so a crash never leaves a partial part behind.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self._writing = set()
+        self._tasks = set()
+        os.makedirs(self.path, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        """
+        Rebuilds the index from the parts left on disk by a previous run. Temporary parts
+        are only removed once stale, other processes sharing the directory may be writing them.
+        """
+        files = []
+        own_tmp = f".{os.getpid()}.tmp"
+        for entry in os.scandir(self.path):
+            if not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # renamed or evicted by another process meanwhile
+                continue
+            if entry.name.endswith(".tmp"):
+                if entry.name.endswith(own_tmp) or stat.st_mtime < time.time() - STALE_TMP_AGE:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+                continue
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+        for name in self._evict():
+            os.remove(os.path.join(self.path, name))
+        logging.info(f"Loaded {len(self.entries)} cached parts ({self.size} bytes) from {self.path}")
+
+    def _evict(self) -> list:
+        evicted = []
+        while self.size > self.max_size and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            evicted.append(name)
+        return evicted
+
+    @staticmethod
+    def _read(path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _write(self, name: str, data: bytes, evicted: list) -> None:
+        path = os.path.join(self.path, name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        for old in evicted:
+            try:
+                os.remove(os.path.join(self.path, old))
+            except FileNotFoundError:
+                pass
+
+    def has(self, unique_id: str, index: int) -> bool:
+        return f"{unique_id}_{index}" in self.entries
+
+    async def get(self, unique_id: str, index: int) -> Optional[bytes]:
+        """
+        Returns the cached part or None, disk reads happen in a worker thread.
+        """
+        name = f"{unique_id}_{index}"
+        if name not in self.entries:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(name)
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(
+                None, self._read, os.path.join(self.path, name)
+            )
+        except OSError:
+            size = self.entries.pop(name, None)
+            if size is not None:
+                self.size -= size
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    async def put(self, unique_id: str, index: int, data: bytes) -> None:
+        name = f"{unique_id}_{index}"
+        if not data or len(data) > self.max_size or name in self.entries or name in self._writing:
+            return
+        self._writing.add(name)
+        # reserve the space first, the part only becomes visible once it is on disk
+        self.size += len(data)
+        try:
+            evicted = self._evict()
+            await asyncio.get_running_loop().run_in_executor(None, self._write, name, data, evicted)
+            self.entries[name] = len(data)
+        except OSError as e:
+            logging.warning(f"Failed to cache part {name}: {e}")
+            self.size -= len(data)
+        finally:
+            self._writing.discard(name)
+
+    def store(self, unique_id: str, index: int, data: bytes) -> None:
+        """
+        Caches the part in the background so the stream doesn't wait for the disk.
+        """
+        task = asyncio.ensure_future(self.put(unique_id, index, data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "parts": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_size,
+        }
+
+
+class MemoryChunkCache:
+    def __init__(self, max_size: int, small_file_size: int):
+        """A small in-memory LRU cache for the parts players ask for before playback starts.
+        attributes:
+            max_size: the byte budget of the cache.
+            small_file_size: files up to this size are kept whole.
+
+        Only the first and the last part of a file (where the MP4 `moov` atom usually is)
+        and every part of small files (photos, stickers, voice notes) are admitted, plus
+        the parts pinned through pin().
+        """
+        self.max_size = max_size
+        self.small_file_size = small_file_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self.pinned: "OrderedDict[str, range]" = OrderedDict()
+
+    def admits(self, unique_id: str, index: int, file_size: int) -> bool:
+        if not file_size:
+            return index == 0
+        return (
+            file_size <= self.small_file_size
+            or index in (0, (file_size - 1) // CHUNK_SIZE)
+            or index in self.pinned.get(unique_id, ())
+        )
+
+    def pin(self, unique_id: str, offset: int, size: int) -> None:
+        """
+        Also admits the parts of a file covering [offset, offset + size), used for
+        the moov / Cues index of videos that isn't at either end of the file.
+        """
+        self.pinned[unique_id] = range(offset // CHUNK_SIZE, (offset + max(size, 1) - 1) // CHUNK_SIZE + 1)
+        self.pinned.move_to_end(unique_id)
+        while len(self.pinned) > MAX_PINNED_FILES:
+            self.pinned.popitem(last=False)
+
+    def get(self, unique_id: str, index: int) -> Optional[bytes]:
+        data = self.entries.get((unique_id, index))
+        if data is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end((unique_id, index))
+        self.hits += 1
+        return data
+
+    def put(self, unique_id: str, index: int, data: bytes) -> None:
+        key = (unique_id, index)
+        if not data or len(data) > self.max_size or key in self.entries:
+            return
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, old = self.entries.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "parts": len(self.entries),
+            "pinned_files": len(self.pinned),
+            "size": self.size,
+            "max_size": self.max_size,
+        }
+
+
+hot_cache = MemoryChunkCache(Var.HOT_CACHE_SIZE, Var.HOT_FILE_SIZE) if Var.HOT_CACHE_SIZE else None
+disk_cache = DiskChunkCache(Var.CACHE_DIR, Var.CACHE_SIZE) if Var.CACHE_DIR else None
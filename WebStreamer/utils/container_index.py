@@ -0,0 +1,404 @@
+# This file is a part of FileStreamBot
+
+import math
+import struct
+import bisect
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, Union
+from .chunk_cache import hot_cache
+
+MAX_INDEX_SIZE = 64 * 1024 * 1024  # largest moov / Cues element read into memory
+MAX_TOP_LEVEL_BOXES = 1024
+MAX_KEYFRAMES = 4096  # seek points stored in the file document
+
+Reader = Callable[[int, int], Awaitable[bytes]]
+
+# Matroska element IDs
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMESTAMP_SCALE = 0x2AD7B1
+DURATION = 0x4489
+CLUSTER = 0x1F43B675
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_CLUSTER_POSITION = 0xF1
+
+
+async def build_index(read: Reader, file_size: int, unique_id: str = None) -> dict:
+    """
+    Parses the container structure of a file once, read(offset, length) returns its bytes.
+    Returns {"format": None} for files that aren't MP4 or Matroska, otherwise a dict with the
+    format, the duration in seconds, the byte range of the index (moov / Cues) and the
+    keyframes as [seconds, byte offset] pairs.
+    """
+    head = await read(0, min(file_size, 16))
+    if len(head) >= 8 and head[4:8] in (b"ftyp", b"moov", b"free", b"skip", b"wide", b"mdat"):
+        index = await index_mp4(read, file_size, unique_id)
+    elif head[:4] == EBML.to_bytes(4, "big"):
+        index = await index_mkv(read, file_size, unique_id)
+    else:
+        index = None
+    return index or {"format": None}
+
+
+def seek(index: dict, seconds: float) -> Tuple[float, int]:
+    """
+    Returns the last keyframe at or before seconds as (seconds, byte offset).
+    """
+    keyframes = index["keyframes"]
+    i = bisect.bisect_right([t for t, _ in keyframes], seconds) - 1
+    return tuple(keyframes[max(i, 0)])
+
+
+def pin_index_range(index: dict, unique_id: str) -> None:
+    """
+    Lets the hot cache keep the parts holding the moov / Cues of the file.
+    """
+    if hot_cache is not None and index.get("index_range"):
+        hot_cache.pin(unique_id, *index["index_range"])
+
+
+def thin_out(keyframes: List[Tuple[float, int]]) -> List[List[float]]:
+    step = max(1, math.ceil(len(keyframes) / MAX_KEYFRAMES))
+    return [[round(t, 3), offset] for t, offset in keyframes[::step]]
+
+
+# -------------------- MP4 -------------------- #
+
+def iter_boxes(data: bytes, start: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """Yields (type, payload start, box end) of the boxes in data[start:end]."""
+    while start + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, start)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, start + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header or start + size > end:
+            return
+        yield box_type, start + header, start + size
+        start += size
+
+
+def header_size(box: bytes) -> int:
+    """The header length of the box data starts with, 16 when it uses a 64-bit largesize."""
+    return 16 if struct.unpack_from(">I", box)[0] == 1 else 8
+
+
+def find_box(data: bytes, start: int, end: int, path: List[bytes]) -> Optional[Tuple[int, int]]:
+    for box_type, payload, box_end in iter_boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return payload, box_end
+            return find_box(data, payload, box_end, path[1:])
+    return None
+
+
+def read_table(data: bytes, box: Optional[Tuple[int, int]], fmt: str, fields: int = 1) -> list:
+    """Reads the entries of a full box made of an entry count and fixed size entries."""
+    if box is None:
+        return []
+    count = struct.unpack_from(">I", data, box[0] + 4)[0]
+    values = struct.unpack_from(f">{count * fields}{fmt}", data, box[0] + 8)
+    if fields == 1:
+        return list(values)
+    return [values[i:i + fields] for i in range(0, len(values), fields)]
+
+
+def parse_track(data: bytes, start: int, end: int) -> Optional[dict]:
+    hdlr = find_box(data, start, end, [b"mdia", b"hdlr"])
+    mdhd = find_box(data, start, end, [b"mdia", b"mdhd"])
+    stbl = find_box(data, start, end, [b"mdia", b"minf", b"stbl"])
+    if hdlr is None or mdhd is None or stbl is None:
+        return None
+    handler = data[hdlr[0] + 8:hdlr[0] + 12]
+    if data[mdhd[0]] == 1:
+        timescale, duration = struct.unpack_from(">IQ", data, mdhd[0] + 20)
+    else:
+        timescale, duration = struct.unpack_from(">II", data, mdhd[0] + 12)
+
+    stsz = find_box(data, stbl[0], stbl[1], [b"stsz"])
+    sample_size, sample_count = struct.unpack_from(">II", data, stsz[0] + 4) if stsz else (0, 0)
+    sizes = list(struct.unpack_from(f">{sample_count}I", data, stsz[0] + 12)) if stsz and not sample_size else None
+    stco = find_box(data, stbl[0], stbl[1], [b"stco"])
+    chunk_offsets = read_table(data, stco, "I") if stco else read_table(data, find_box(data, stbl[0], stbl[1], [b"co64"]), "Q")
+    return {
+        "handler": handler,
+        "timescale": timescale or 1,
+        "duration": duration,
+        "stts": read_table(data, find_box(data, stbl[0], stbl[1], [b"stts"]), "I", 2),
+        "stss": read_table(data, find_box(data, stbl[0], stbl[1], [b"stss"]), "I"),
+        "stsc": read_table(data, find_box(data, stbl[0], stbl[1], [b"stsc"]), "I", 3),
+        "sample_size": sample_size,
+        "sample_count": sample_count,
+        "sizes": sizes,
+        "chunk_offsets": chunk_offsets,
+    }
+
+
+def track_keyframes(track: dict) -> List[Tuple[float, int]]:
+    """Maps the sync samples of a track to (seconds, byte offset)."""
+    sample_count = track["sample_count"]
+    wanted = track["stss"] or range(1, sample_count + 1)
+    if len(wanted) > MAX_KEYFRAMES:
+        step = math.ceil(len(wanted) / MAX_KEYFRAMES)
+        wanted = wanted[::step]
+    if not wanted:
+        return []
+
+    # decoding time of every wanted sample from the stts runs
+    times = []
+    sample, elapsed, w = 1, 0, 0
+    for count, delta in track["stts"]:
+        while w < len(wanted) and wanted[w] < sample + count:
+            times.append((elapsed + (wanted[w] - sample) * delta) / track["timescale"])
+            w += 1
+        sample += count
+        elapsed += count * delta
+
+    # byte offset of every wanted sample from the stsc runs and the chunk offsets
+    offsets = []
+    sizes, sample_size = track["sizes"], track["sample_size"]
+    stsc, chunk_offsets = track["stsc"], track["chunk_offsets"]
+    sample, w = 1, 0
+    for run, (first_chunk, per_chunk, _) in enumerate(stsc):
+        last_chunk = stsc[run + 1][0] - 1 if run + 1 < len(stsc) else len(chunk_offsets)
+        for chunk in range(first_chunk, last_chunk + 1):
+            if w >= len(wanted):
+                break
+            while w < len(wanted) and wanted[w] < sample + per_chunk:
+                before = wanted[w] - sample
+                skipped = sum(sizes[sample - 1:sample - 1 + before]) if sizes else before * sample_size
+                offsets.append(chunk_offsets[chunk - 1] + skipped)
+                w += 1
+            sample += per_chunk
+    return list(zip(times, offsets))
+
+
+async def index_mp4(read: Reader, file_size: int, unique_id: str = None) -> Optional[dict]:
+    boxes = []
+    offset = 0
+    while offset + 8 <= file_size and len(boxes) < MAX_TOP_LEVEL_BOXES:
+        header = await read(offset, min(16, file_size - offset))
+        size, box_type = struct.unpack_from(">I4s", header)
+        if size == 1:
+            size = struct.unpack_from(">Q", header, 8)[0]
+        elif size == 0:
+            size = file_size - offset
+        if size < 8:
+            break
+        boxes.append([box_type.decode("latin-1"), offset, size])
+        offset += size
+
+    moov = next((box for box in boxes if box[0] == "moov"), None)
+    if moov is None or moov[2] > MAX_INDEX_SIZE:
+        return None
+    index = {"format": "mp4", "boxes": boxes, "index_range": moov[1:]}
+    if unique_id:
+        pin_index_range(index, unique_id)
+    data = await read(moov[1], moov[2])
+    tracks = [
+        track for track in (
+            parse_track(data, payload, box_end)
+            for box_type, payload, box_end in iter_boxes(data, header_size(data), len(data))
+            if box_type == b"trak"
+        ) if track
+    ]
+    if not tracks:
+        return None
+    track = next((t for t in tracks if t["handler"] == b"vide"), tracks[0])
+    index["duration"] = round(track["duration"] / track["timescale"], 3)
+    index["keyframes"] = thin_out(track_keyframes(track))
+    return index
+
+
+# -------------------- virtual faststart -------------------- #
+
+def faststart_plan(index: dict) -> Optional[Tuple[int, int, int]]:
+    """
+    Returns (head end, moov offset, moov size) for MP4s whose moov comes after the media
+    data, None when the file already starts with its moov or can't be remapped.
+    """
+    if index.get("format") != "mp4":
+        return None
+    types = [box[0] for box in index["boxes"]]
+    if "moov" not in types or "mdat" not in types or "moof" in types:
+        return None
+    _, moov_offset, moov_size = index["boxes"][types.index("moov")]
+    head_end = index["boxes"][types.index("mdat")][1]
+    if moov_offset < head_end:
+        return None
+    return head_end, moov_offset, moov_size
+
+
+def patch_moov(moov: bytes, head_end: int, moov_offset: int) -> Optional[bytes]:
+    """
+    Shifts the chunk offsets pointing into [head_end, moov_offset) by the moov size, the
+    bytes moving behind the moov once it is served first. Returns None when a 32 bit stco
+    entry would overflow, rewriting it as co64 would change the moov size.
+    """
+    data = bytearray(moov)
+    shift = len(data)
+    header = header_size(data)
+    for box_type, payload, box_end in iter_boxes(data, header, len(data)):
+        if box_type != b"trak":
+            continue
+        stbl = find_box(data, payload, box_end, [b"mdia", b"minf", b"stbl"])
+        if stbl is None:
+            continue
+        for name, fmt in ((b"stco", "I"), (b"co64", "Q")):
+            box = find_box(data, stbl[0], stbl[1], [name])
+            if box is None:
+                continue
+            count = struct.unpack_from(">I", data, box[0] + 4)[0]
+            offsets = [
+                offset + shift if head_end <= offset < moov_offset else offset
+                for offset in struct.unpack_from(f">{count}{fmt}", data, box[0] + 8)
+            ]
+            if fmt == "I" and offsets and max(offsets) >= 2 ** 32:
+                return None
+            struct.pack_into(f">{count}{fmt}", data, box[0] + 8, *offsets)
+    return bytes(data)
+
+
+def faststart_segments(
+    head_end: int, moov_offset: int, moov: bytes, file_size: int
+) -> List[Tuple[int, int, Union[int, bytes]]]:
+    """
+    Returns the virtual layout ftyp | patched moov | [head_end, moov_offset) | after moov
+    as (virtual offset, length, source) where source is the original offset of the bytes
+    or the bytes themselves. The layout has the same size as the file.
+    """
+    size = len(moov)
+    return [
+        (0, head_end, 0),
+        (head_end, size, moov),
+        (head_end + size, moov_offset - head_end, head_end),
+        (moov_offset + size, file_size - moov_offset - size, moov_offset + size),
+    ]
+
+
+# -------------------- Matroska -------------------- #
+
+def read_vint(data: bytes, pos: int, marker: bool) -> Tuple[Optional[int], int]:
+    """Reads an EBML variable length integer, keeping the length marker for IDs.
+    Returns (value, next position), value is None for the reserved unknown size."""
+    first = data[pos]
+    length, mask = 1, 0x80
+    while length <= 8 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 8:
+        raise ValueError("Invalid EBML variable length integer")
+    value = first if marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    if not marker and value == (1 << (7 * length)) - 1:
+        value = None
+    return value, pos + length
+
+
+def iter_elements(data: bytes, start: int, end: int) -> Iterator[Tuple[int, int, int]]:
+    """Yields (id, data start, data end) of the EBML elements in data[start:end]."""
+    while start < end:
+        element_id, pos = read_vint(data, start, True)
+        size, pos = read_vint(data, pos, False)
+        if size is None or pos + size > end:
+            return
+        yield element_id, pos, pos + size
+        start = pos + size
+
+
+def read_uint(data: bytes, start: int, end: int) -> int:
+    return int.from_bytes(data[start:end], "big")
+
+
+async def read_element(read: Reader, offset: int, file_size: int) -> Tuple[int, Optional[int], int]:
+    """Reads the header of the element at offset, returns (id, size, data offset)."""
+    header = await read(offset, min(12, file_size - offset))
+    element_id, pos = read_vint(header, 0, True)
+    size, pos = read_vint(header, pos, False)
+    return element_id, size, offset + pos
+
+
+async def index_mkv(read: Reader, file_size: int, unique_id: str = None) -> Optional[dict]:
+    element_id, size, pos = await read_element(read, 0, file_size)
+    if element_id != EBML or size is None:
+        return None
+    element_id, _, segment_start = await read_element(read, pos + size, file_size)
+    if element_id != SEGMENT:
+        return None
+
+    # the SeekHead, Info and often Cues come before the first Cluster
+    positions: Dict[int, int] = {}
+    offset = segment_start
+    for _ in range(32):
+        if offset + 2 > file_size:
+            break
+        element_id, size, data_start = await read_element(read, offset, file_size)
+        if element_id == CLUSTER or size is None:
+            break
+        positions.setdefault(element_id, offset)
+        if element_id == SEEK_HEAD and size <= MAX_INDEX_SIZE:
+            data = await read(data_start, size)
+            for seek_id, start, end in iter_elements(data, 0, len(data)):
+                if seek_id != SEEK:
+                    continue
+                target, position = None, None
+                for child_id, child_start, child_end in iter_elements(data, start, end):
+                    if child_id == SEEK_ID:
+                        target = read_uint(data, child_start, child_end)
+                    elif child_id == SEEK_POSITION:
+                        position = read_uint(data, child_start, child_end)
+                if target is not None and position is not None:
+                    positions.setdefault(target, segment_start + position)
+        offset = data_start + size
+
+    if CUES not in positions:
+        return None
+
+    scale, duration = 1000000, None
+    if INFO in positions:
+        _, size, data_start = await read_element(read, positions[INFO], file_size)
+        if size is not None and size <= MAX_INDEX_SIZE:
+            data = await read(data_start, size)
+            for child_id, start, end in iter_elements(data, 0, len(data)):
+                if child_id == TIMESTAMP_SCALE:
+                    scale = read_uint(data, start, end) or scale
+                elif child_id == DURATION:
+                    duration = struct.unpack(">f" if end - start == 4 else ">d", data[start:end])[0]
+
+    element_id, size, data_start = await read_element(read, positions[CUES], file_size)
+    if element_id != CUES or size is None or size > MAX_INDEX_SIZE:
+        return None
+    index = {"format": "matroska", "index_range": [positions[CUES], data_start - positions[CUES] + size]}
+    if unique_id:
+        pin_index_range(index, unique_id)
+    data = await read(data_start, size)
+    keyframes = []
+    for cue_id, start, end in iter_elements(data, 0, len(data)):
+        if cue_id != CUE_POINT:
+            continue
+        cue_time, cluster = None, None
+        for child_id, child_start, child_end in iter_elements(data, start, end):
+            if child_id == CUE_TIME:
+                cue_time = read_uint(data, child_start, child_end)
+            elif child_id == CUE_TRACK_POSITIONS and cluster is None:
+                for pos_id, pos_start, pos_end in iter_elements(data, child_start, child_end):
+                    if pos_id == CUE_CLUSTER_POSITION:
+                        cluster = read_uint(data, pos_start, pos_end)
+        if cue_time is not None and cluster is not None:
+            keyframes.append((cue_time * scale / 1e9, segment_start + cluster))
+    if not keyframes:
+        return None
+    keyframes.sort()
+    index["duration"] = round(duration * scale / 1e9, 3) if duration else keyframes[-1][0]
+    index["keyframes"] = thin_out(keyframes)
+    return index
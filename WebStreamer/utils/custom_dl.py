@@ -1,23 +1,45 @@
 # This file is a part of FileStreamBot
 
+import time
 import asyncio
 import logging
-from typing import Dict, Union
-from WebStreamer.bot import work_loads
+from collections import deque
+from typing import AsyncGenerator, Deque, Dict, List, Optional, Tuple, Union
+from WebStreamer.vars import Var
+from WebStreamer.bot import work_loads, scheduler
 from pyrogram import Client, utils, raw
-from .file_properties import get_file_ids
-from pyrogram.session import Session, Auth
-from pyrogram.errors import AuthBytesInvalid
+from .file_properties import get_file_ids, refresh_file_id
+from .chunk_cache import disk_cache, hot_cache, CHUNK_SIZE
+from .session_pool import get_session_pool
+from .range_planner import plan_range, range_stats
+from .lru_cache import TTLCache
+from .metrics import GETFILE_SECONDS, CLIENT_BYTES, FLOOD_WAITS, HistogramChild
+from pyrogram.session import Session
+from pyrogram.errors import FloodWait, FileReferenceExpired, FileReferenceInvalid
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
 
 
+# (database id, client id) -> FileId, shared by every ByteStreamer
+file_id_cache = TTLCache(Var.FILE_CACHE_SIZE, Var.FILE_CACHE_TTL)
+
+# (media id, offset, limit) -> [task fetching the part, number of streams waiting for it]
+inflight_parts: Dict[Tuple[int, int, int], list] = {}
+
+
 class ByteStreamer:
-    def __init__(self, client: Client):
+    coalesced_parts = 0
+    refreshed_references = 0
+
+    def __init__(self, client: Client, index: int):
         """A custom class that holds the cache of a specific client and class functions.
         attributes:
             client: the client that the cache is for.
-            cached_file_ids: a dict of cached file IDs.
-            cached_file_properties: a dict of cached file properties.
+            index: the key of the client in multi_clients and work_loads.
+            refresh_locks: file id -> [lock serialising its reference refreshes, number of
+                streams holding or waiting for it], dropped once nobody does.
+            getfile_seconds: the GetFile latency histogram of this client per DC.
+
+        the FileIds of every client live in the shared file_id_cache.
         
         functions:
             generate_file_properties: returns the properties for a media of a specific message contained in Tuple.
@@ -27,10 +49,13 @@ class ByteStreamer:
         This is a modified version of the <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py>
         Thanks to Eyaadh <https://github.com/eyaadh>
         """
-        self.clean_timer = 30 * 60
         self.client: Client = client
-        self.cached_file_ids: Dict[str, FileId] = {}
-        asyncio.create_task(self.clean_cache())
+        self.index = index
+        self.refresh_locks: Dict[str, list] = {}
+        self.name = f"bot{index + 1}"
+        self.getfile_seconds: Dict[int, HistogramChild] = {}
+        self.bytes_metric = CLIENT_BYTES.labels(self.name)
+        self.flood_wait_metric = FLOOD_WAITS.labels(self.name)
 
     async def get_file_properties(self, db_id: str, multi_clients) -> FileId:
         """
@@ -38,12 +63,10 @@ class ByteStreamer:
         if the properties are cached, then it'll return the cached results.
         or it'll generate the properties from the Message ID and cache them.
         """
-        if not db_id in self.cached_file_ids:
-            logging.debug("Before Calling generate_file_properties")
-            await self.generate_file_properties(db_id, multi_clients)
-            logging.debug(f"Cached file properties for file with ID {db_id}")
-        return self.cached_file_ids[db_id]
-    
+        return await file_id_cache.get_or_load(
+            (db_id, self.client.id), lambda: self.generate_file_properties(db_id, multi_clients)
+        )
+
     async def generate_file_properties(self, db_id: str, multi_clients) -> FileId:
         """
         Generates the properties of a media file on a specific message.
@@ -52,66 +75,35 @@ class ByteStreamer:
         logging.debug("Before calling get_file_ids")
         file_id = await get_file_ids(self.client, db_id, multi_clients)
         logging.debug(f"Generated file ID and Unique ID for file with ID {db_id}")
-        self.cached_file_ids[db_id] = file_id
-        logging.debug(f"Cached media file with ID {db_id}")
-        return self.cached_file_ids[db_id]
+        return file_id
 
     async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
         """
-        Generates the media session for the DC that contains the media file.
+        Returns the media session for the DC that contains the media file.
         This is required for getting the bytes from Telegram servers.
         """
+        return await get_session_pool(client).get(file_id.dc_id)
 
-        media_session = client.media_sessions.get(file_id.dc_id, None)
-
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await Auth(
-                        client, file_id.dc_id, await client.storage.test_mode()
-                    ).create(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-
-                for _ in range(6):
-                    exported_auth = await client.invoke(
-                        raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id)
-                    )
-
-                    try:
-                        await media_session.invoke(
-                            raw.functions.auth.ImportAuthorization(
-                                id=exported_auth.id, bytes=exported_auth.bytes
-                            )
-                        )
-                        break
-                    except AuthBytesInvalid:
-                        logging.debug(
-                            f"Invalid authorization bytes for DC {file_id.dc_id}"
-                        )
-                        continue
-                else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
-            else:
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await client.storage.auth_key(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-            logging.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
-        else:
-            logging.debug(f"Using cached media session for DC {file_id.dc_id}")
-        return media_session
-
+    async def refresh_file_reference(self, file_id: FileId, expired_reference: bytes):
+        """
+        Replaces the expired file reference of a FileId in place, so every stream and
+        the cache holding it pick up the new one. Returns the new file location.
+        """
+        db_id = file_id.db_id
+        entry = self.refresh_locks.setdefault(db_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                # another stream may have refreshed it while we were waiting
+                if file_id.file_reference == expired_reference:
+                    new_file_id = await refresh_file_id(self.client, db_id)
+                    file_id.file_reference = new_file_id.file_reference
+                    ByteStreamer.refreshed_references += 1
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self.refresh_locks.pop(db_id, None)
+        return await self.get_location(file_id)
 
     @staticmethod
     async def get_location(file_id: FileId) -> Union[raw.types.InputPhotoFileLocation,
@@ -158,7 +150,7 @@ class ByteStreamer:
             )
         return location
 
-    async def yield_file(
+    def yield_file(
         self,
         file_id: FileId,
         index: int,
@@ -167,64 +159,212 @@ class ByteStreamer:
         last_part_cut: int,
         part_count: int,
         chunk_size: int,
-    ) -> Union[str, None]:
+    ) -> AsyncGenerator[bytes, None]:
         """
         Custom generator that yields the bytes of the media file.
         Modded from <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py#L20>
         Thanks to Eyaadh <https://github.com/eyaadh>
         """
-        client = self.client
-        work_loads[index] += 1
-        logging.debug(f"Starting to yielding file with client {index}.")
-        media_session = await self.generate_media_session(client, file_id)
+        return self.yield_file_striped(
+            [(self, file_id, index)], offset, first_part_cut, last_part_cut, part_count, chunk_size
+        )
 
-        current_part = 1
+    @staticmethod
+    def plan(file_id: FileId, from_b: int, to_b: int) -> Tuple[int, int, int, int, int]:
+        """
+        Returns the yield_file arguments after the client index for the bytes from_b..to_b.
+        Short ranges are fetched as whole parts when the memory cache admits a part or the
+        disk cache already holds one, so small files and tail probes end up cached and
+        repeated requests are sliced out of the cached parts. Other short ranges keep small
+        limits, a whole part fetched for them would only be written to disk to be evicted.
+        """
+        unique_id = getattr(file_id, "unique_id", None)
+        file_size = getattr(file_id, "file_size", 0)
+        whole_parts = bool(unique_id) and any(
+            hot_cache is not None and hot_cache.admits(unique_id, index, file_size)
+            or disk_cache is not None and disk_cache.has(unique_id, index)
+            for index in (from_b // CHUNK_SIZE, to_b // CHUNK_SIZE)
+        )
+        return plan_range(from_b, to_b, whole_parts)
 
-        location = await self.get_location(file_id)
+    async def read_bytes(self, file_id: FileId, offset: int, length: int) -> bytes:
+        """
+        Returns length bytes of the media file starting at offset.
+        """
+        end = min(offset + length, file_id.file_size) - 1
+        if end < offset:
+            return b""
+        plan = self.plan(file_id, offset, end)
+        return b"".join([chunk async for chunk in self.yield_file(file_id, self.index, *plan)])
+
+    @staticmethod
+    async def yield_file_striped(
+        streams: List[Tuple["ByteStreamer", FileId, int]],
+        offset: int,
+        first_part_cut: int,
+        last_part_cut: int,
+        part_count: int,
+        chunk_size: int,
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Yields the bytes of the media file while spreading the parts over several clients.
+        streams is a list of (ByteStreamer, FileId of that client, client index), part n is
+        fetched by streams[n % len(streams)] and the parts are yielded back in order.
+        """
+        indexes = [index for _, _, index in streams]
+        for index in indexes:
+            work_loads[index] += 1
+        logging.debug(f"Starting to yielding file with clients {indexes}.")
+
+        current_part = 1
+        requested_parts = 0
+        next_offset = offset
+        window = max(1, Var.PREFETCH_WINDOW) * len(streams)
+        pending: Deque[asyncio.Task] = deque()
 
         try:
-            r = await media_session.invoke(
-                raw.functions.upload.GetFile(
-                    location=location, offset=offset, limit=chunk_size
-                ),
-            )
-            if isinstance(r, raw.types.upload.File):
-                while True:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    elif part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                    elif current_part == 1:
-                        yield chunk[first_part_cut:]
-                    elif current_part == part_count:
-                        yield chunk[:last_part_cut]
-                    else:
-                        yield chunk
-
-                    current_part += 1
-                    offset += chunk_size
-
-                    if current_part > part_count:
-                        break
-
-                    r = await media_session.invoke(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
-                    )
+            while current_part <= part_count:
+                # keep up to `window` GetFile requests in flight, results are
+                # consumed strictly in order so at most `window` chunks are buffered
+                while len(pending) < window and requested_parts < part_count:
+                    streamer, file_id, _ = streams[requested_parts % len(streams)]
+                    part = requested_parts + 1
+                    used = (last_part_cut if part == part_count else chunk_size) - (first_part_cut if part == 1 else 0)
+                    pending.append(asyncio.ensure_future(
+                        streamer.get_chunk(file_id, next_offset, chunk_size, used)
+                    ))
+                    next_offset += chunk_size
+                    requested_parts += 1
+
+                chunk = await pending.popleft()
+                if not chunk:
+                    break
+                elif part_count == 1:
+                    yield chunk[first_part_cut:last_part_cut]
+                elif current_part == 1:
+                    yield chunk[first_part_cut:]
+                elif current_part == part_count:
+                    yield chunk[:last_part_cut]
+                else:
+                    yield chunk
+
+                current_part += 1
         except (TimeoutError, AttributeError):
             pass
         finally:
+            # the client went away or the stream ended early, drop prefetched parts
+            for task in pending:
+                if task.done() and not task.cancelled():
+                    task.exception()
+                else:
+                    task.cancel()
             logging.debug(f"Finished yielding file with {current_part} parts.")
-            work_loads[index] -= 1
+            for index in indexes:
+                work_loads[index] -= 1
 
-    
-    async def clean_cache(self) -> None:
+    async def get_chunk(self, file_id: FileId, offset: int, limit: int, used: Optional[int] = None) -> bytes:
+        """
+        Returns a single part of the media file, from the memory or disk cache when possible.
+        Only whole, aligned 1 MiB parts are cached, smaller parts are sliced out of them.
+        used is how many bytes of the part the stream sends on, defaults to the whole part.
+        """
+        unique_id = getattr(file_id, "unique_id", None)
+        index, start = divmod(offset, CHUNK_SIZE)
+        cacheable = unique_id and limit == CHUNK_SIZE and start == 0
+        hot = unique_id and hot_cache is not None and hot_cache.admits(unique_id, index, getattr(file_id, "file_size", 0))
+        if hot:
+            chunk = hot_cache.get(unique_id, index)
+            if chunk is not None:
+                return chunk[start:start + limit]
+        if unique_id and disk_cache is not None and (cacheable or disk_cache.has(unique_id, index)):
+            chunk = await disk_cache.get(unique_id, index)
+            if chunk is not None:
+                if hot:
+                    hot_cache.put(unique_id, index, chunk)
+                return chunk[start:start + limit]
+        hot = hot and cacheable
+
+        # identical requests from concurrent streams share one GetFile
+        key = (file_id.media_id, offset, limit)
+        entry = inflight_parts.get(key)
+        if entry is None:
+            entry = inflight_parts[key] = [asyncio.ensure_future(self.download_chunk(file_id, offset, limit, hot, limit if used is None else used)), 0]
+            entry[0].add_done_callback(lambda _: inflight_parts.pop(key, None))
+        else:
+            ByteStreamer.coalesced_parts += 1
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    async def download_chunk(self, file_id: FileId, offset: int, limit: int, hot: bool, used: int) -> bytes:
+        """
+        Fetches a part from telegram and stores it in the caches, bytes beyond the used
+        ones are counted as wasted unless a cache keeps the part.
+        """
+        try:
+            media_session = await self.generate_media_session(self.client, file_id)
+            location = await self.get_location(file_id)
+            start = time.monotonic()
+            file_reference = file_id.file_reference
+            try:
+                chunk = await self.fetch_chunk(media_session, location, offset, limit)
+            except (FileReferenceExpired, FileReferenceInvalid):
+                # resume at the same offset with a fresh reference, the stream doesn't notice
+                location = await self.refresh_file_reference(file_id, file_reference)
+                start = time.monotonic()
+                chunk = await self.fetch_chunk(media_session, location, offset, limit)
+            except TimeoutError:
+                # the media session may be dead, retry once, on a new one if it doesn't answer a ping
+                scheduler.record_error(self.index)
+                media_session = await get_session_pool(self.client).recover(file_id.dc_id, media_session)
+                start = time.monotonic()
+                chunk = await self.fetch_chunk(media_session, location, offset, limit)
+            seconds = time.monotonic() - start
+            scheduler.record_chunk(self.index, len(chunk), seconds)
+            self.getfile_histogram(file_id.dc_id).observe(seconds)
+            self.bytes_metric.inc(len(chunk))
+        except FloodWait as e:
+            scheduler.record_flood_wait(self.index, e.value)
+            self.flood_wait_metric.inc()
+            raise
+        except Exception:
+            scheduler.record_error(self.index)
+            raise
+        range_stats["fetched_bytes"] += len(chunk)
+        unique_id = getattr(file_id, "unique_id", None)
+        if chunk and unique_id and limit == CHUNK_SIZE and offset % CHUNK_SIZE == 0 and (hot or disk_cache is not None):
+            if hot:
+                hot_cache.put(unique_id, offset // CHUNK_SIZE, chunk)
+            if disk_cache is not None:
+                disk_cache.store(unique_id, offset // CHUNK_SIZE, chunk)
+        else:
+            range_stats["wasted_bytes"] += max(0, len(chunk) - used)
+        return chunk
+
+    def getfile_histogram(self, dc_id: int) -> HistogramChild:
+        histogram = self.getfile_seconds.get(dc_id)
+        if histogram is None:
+            histogram = self.getfile_seconds[dc_id] = GETFILE_SECONDS.labels(self.name, dc_id)
+        return histogram
+
+    @staticmethod
+    async def fetch_chunk(media_session: Session, location, offset: int, limit: int) -> bytes:
         """
-        function to clean the cache to reduce memory usage
+        Fetches a single part of the media file, returns empty bytes if telegram
+        didn't answer with the file content.
         """
-        while True:
-            await asyncio.sleep(self.clean_timer)
-            self.cached_file_ids.clear()
-            logging.debug("Cleaned the cache")
+        r = await media_session.invoke(
+            raw.functions.upload.GetFile(
+                location=location, offset=offset, limit=limit
+            ),
+        )
+        if isinstance(r, raw.types.upload.File):
+            return r.bytes
+        return b""
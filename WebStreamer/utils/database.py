@@ -1,12 +1,17 @@
+import re
 import time
 import math
 import logging
+from typing import Callable, Dict, List, Optional, Tuple
 import motor.motor_asyncio
 import pymongo
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
 from WebStreamer.server.exceptions import FIleNotFound
 from WebStreamer.vars import Var
+from WebStreamer.utils.metrics import mongo_listener
+from WebStreamer.utils.search_index import search_index, tokenize
+from WebStreamer.utils.title_parser import parse_title, parse_titles, release_metadata
 
 # Set up basic logging
 logging.basicConfig(
@@ -14,32 +19,64 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+RANK_CURSOR = "rank:"  # prefix of the /search cursors paging through ranked results
 
 class Database:
+    # one motor client (and connection pool) per URI, shared by every Database instance
+    _clients: Dict[str, motor.motor_asyncio.AsyncIOMotorClient] = {}
+    # called with ("add", file document) or ("delete", {"_id": ...}) after the file collection changed
+    _change_listeners: List[Callable[[str, dict], None]] = []
+
     def __init__(self, uri: str, database_name: str):
         try:
-            self._client = motor.motor_asyncio.AsyncIOMotorClient(uri, serverSelectionTimeoutMS=5000)
+            self._client = self.get_client(uri)
             self.db = self._client[database_name]
             self.users_col = self.db.users
             self.blacklist_col = self.db.blacklist
+            self.broadcasts_col = self.db.broadcasts
             self.files_col = self.db.file
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
             raise
 
+    @classmethod
+    def get_client(cls, uri: str) -> motor.motor_asyncio.AsyncIOMotorClient:
+        client = cls._clients.get(uri)
+        if client is None:
+            client = cls._clients[uri] = motor.motor_asyncio.AsyncIOMotorClient(
+                uri, serverSelectionTimeoutMS=5000, event_listeners=[mongo_listener]
+            )
+        return client
+
+    @classmethod
+    def add_change_listener(cls, listener: Callable[[str, dict], None]) -> None:
+        cls._change_listeners.append(listener)
+
+    def _notify(self, event: str, doc: dict) -> None:
+        for listener in self._change_listeners:
+            try:
+                listener(event, doc)
+            except Exception as e:
+                logger.error(f"File change listener {listener} failed: {e}")
+
     async def create_indexes(self):
         """Create necessary indexes for efficient queries."""
-        try:
-            await self.users_col.create_index([("id", pymongo.ASCENDING)], unique=True)
-            await self.blacklist_col.create_index([("id", pymongo.ASCENDING)], unique=True)
-            await self.files_col.create_index([
-                ("user_id", pymongo.ASCENDING), 
-                ("file_unique_id", pymongo.ASCENDING)
-            ])
-            await self.files_col.create_index([("file_name", pymongo.TEXT)])
-            logger.info("Database indexes created successfully.")
-        except Exception as e:
-            logger.error(f"Failed to create indexes: {e}")
+        indexes = [
+            (self.users_col, [("id", pymongo.ASCENDING)], {"unique": True}),
+            (self.blacklist_col, [("id", pymongo.ASCENDING)], {"unique": True}),
+            (self.files_col, [("user_id", pymongo.ASCENDING), ("file_unique_id", pymongo.ASCENDING)], {}),
+            (self.files_col, [("time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)], {}),
+            (self.files_col, [("file_name", pymongo.TEXT)], {}),
+            (self.files_col, [("meta.title_key", pymongo.ASCENDING), ("meta.season", pymongo.ASCENDING), ("meta.episode", pymongo.ASCENDING)], {}),
+            (self.files_col, [("meta.year", pymongo.ASCENDING), ("time", pymongo.DESCENDING)], {}),
+        ]
+        # one failing index (e.g. duplicates under a unique one) doesn't skip the others
+        for col, keys, options in indexes:
+            try:
+                await col.create_index(keys, **options)
+            except Exception as e:
+                logger.error(f"Failed to create index {keys} on {col.name}: {e}")
+        logger.info("Database indexes created.")
 
     # -------------------- USER MANAGEMENT -------------------- #
     def _new_user(self, user_id: int) -> dict:
@@ -88,6 +125,11 @@ class Database:
             logger.error(f"Error fetching all users: {e}")
             return []
 
+    def users_after(self, last_user_id: Optional[int] = None):
+        """Cursor over the user ids in ascending order, after last_user_id when given."""
+        query_filter = {} if last_user_id is None else {"id": {"$gt": last_user_id}}
+        return self.users_col.find(query_filter, {"id": 1, "_id": 0}).sort("id", 1).batch_size(1000)
+
     async def agree_to_tos(self, user_id: int):
         try:
             await self.users_col.update_one(
@@ -133,6 +175,20 @@ class Database:
             logger.error(f"Error counting banned users: {e}")
             return 0
 
+    # -------------------- BROADCASTS -------------------- #
+    async def save_broadcast(self, state: dict):
+        try:
+            await self.broadcasts_col.replace_one({"_id": state["_id"]}, state, upsert=True)
+        except Exception as e:
+            logger.error(f"Error saving broadcast {state.get('_id')}: {e}")
+
+    async def get_running_broadcasts(self):
+        try:
+            return await self.broadcasts_col.find({"status": "running"}).to_list(length=None)
+        except Exception as e:
+            logger.error(f"Error fetching running broadcasts: {e}")
+            return []
+
     # -------------------- FILE MANAGEMENT -------------------- #
     async def add_file(self, file_info: dict):
         try:
@@ -140,8 +196,11 @@ class Database:
             existing = await self.get_file_by_fileuniqueid(file_info["user_id"], file_info["file_unique_id"])
             if existing:
                 return existing["_id"]
+            if "meta" not in file_info:
+                file_info["meta"] = release_metadata(await parse_title(file_info.get("file_name") or ""))
             result = await self.files_col.insert_one(file_info)
             logger.info(f"New file added for user {file_info['user_id']} with ID {result.inserted_id}")
+            self._notify("add", file_info)
             return result.inserted_id
         except Exception as e:
             logger.error(f"Error adding file for user {file_info.get('user_id')}: {e}")
@@ -160,9 +219,13 @@ class Database:
             return [], 0, 0
 
     async def search_files(self, user_id: int, query: str, page: int = 1, limit: int = 10):
+        offset = (page - 1) * limit
         try:
-            offset = (page - 1) * limit
-            query_filter = {"user_id": user_id, "file_name": {"$regex": query, "$options": "i"}}
+            if search_index.ready:
+                ids, total_files = await search_index.search(query, user_id, limit, offset)
+                return await self._files_by_ids(ids), total_files, math.ceil(total_files / limit)
+            # the index is still loading, scan the files of the user
+            query_filter = {"user_id": user_id, "file_name": {"$regex": re.escape(query), "$options": "i"}}
             cursor = self.files_col.find(query_filter).sort("_id", -1).skip(offset).limit(limit)
             files_list = await cursor.to_list(length=limit)
             total_files = await self.files_col.count_documents(query_filter)
@@ -172,6 +235,138 @@ class Database:
             logger.error(f"Error searching files for user {user_id} with query '{query}': {e}")
             return [], 0, 0
 
+    async def build_search_index(self):
+        try:
+            await search_index.build(self.files_col)
+        except Exception as e:
+            logger.error(f"Failed to build the search index: {e}")
+
+    async def backfill_metadata(self, batch_size: int = 1000, attempts: int = 3):
+        """
+        Stores the parsed release metadata of the files added before it was computed at ingest.
+        A batch failing every attempt is skipped, its files are picked up again on the next start.
+        """
+        done = skipped = 0
+        try:
+            cursor = self.files_col.find({"meta": {"$exists": False}}, {"file_name": 1}).batch_size(batch_size)
+            while True:
+                docs = await cursor.to_list(length=batch_size)
+                if not docs:
+                    break
+                for attempt in range(1, attempts + 1):
+                    try:
+                        await self._backfill_batch(docs)
+                        done += len(docs)
+                        break
+                    except Exception as e:
+                        logger.warning(f"Backfilling release metadata of {len(docs)} files failed (attempt {attempt}): {e}")
+                else:
+                    skipped += len(docs)
+                logger.info(f"Backfilled release metadata of {done} files, skipped {skipped}.")
+        except Exception as e:
+            logger.error(f"Failed to backfill release metadata after {done} files: {e}")
+
+    async def _backfill_batch(self, docs: List[dict]):
+        parsed = await parse_titles([doc.get("file_name") or "" for doc in docs])
+        await self.files_col.bulk_write([
+            pymongo.UpdateOne({"_id": doc["_id"]}, {"$set": {"meta": release_metadata(p)}})
+            for doc, p in zip(docs, parsed)
+        ], ordered=False)
+
+    async def find_episodes(self, title: str, season: Optional[int] = None, limit: int = 500):
+        """Files of a show ordered by season and episode, an indexed lookup on the parsed title."""
+        query_filter = {"meta.title_key": " ".join(tokenize(title)), "meta.episode": {"$exists": True}}
+        if season is not None:
+            query_filter["meta.season"] = season
+        try:
+            cursor = self.files_col.find(query_filter, {"file_name": 1, "meta": 1}).sort(
+                [("meta.title_key", 1), ("meta.season", 1), ("meta.episode", 1)]
+            ).limit(limit)
+            return await cursor.to_list(length=limit)
+        except Exception as e:
+            logger.error(f"Error finding episodes of '{title}': {e}")
+            return []
+
+    # -------------------- CATALOG -------------------- #
+    @staticmethod
+    def _encode_cursor(doc: dict) -> str:
+        return f"{doc.get('time', 0)!r}:{doc['_id']}"
+
+    @staticmethod
+    def _after_cursor(cursor: Optional[str]) -> dict:
+        """Filter for the files after a `time:_id` cursor in (time, _id) descending order."""
+        if not cursor:
+            return {}
+        try:
+            added, _id = cursor.split(":", 1)
+            added, _id = float(added), ObjectId(_id)
+        except (ValueError, InvalidId):
+            raise ValueError(f"Invalid cursor: {cursor}")
+        return {"$or": [{"time": {"$lt": added}}, {"time": added, "_id": {"$lt": _id}}]}
+
+    async def _catalog_page(self, query_filter: dict, limit: int, cursor: Optional[str]) -> Tuple[List[dict], Optional[str]]:
+        after = self._after_cursor(cursor)
+        if after:
+            query_filter = {"$and": [query_filter, after]} if query_filter else after
+        docs = await self.files_col.find(
+            query_filter, {"file_name": 1, "time": 1}
+        ).sort([("time", -1), ("_id", -1)]).limit(limit + 1).to_list(length=limit + 1)
+        next_cursor = self._encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+        return docs[:limit], next_cursor
+
+    async def latest_file(self) -> Optional[dict]:
+        try:
+            return await self.files_col.find_one({}, {"time": 1}, sort=[("time", -1), ("_id", -1)])
+        except Exception as e:
+            logger.error(f"Error getting the latest file: {e}")
+            return None
+
+    async def list_catalog(self, limit: int = 10, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """Returns a page of the newest files and the cursor of the next page. Raises ValueError for a bad cursor."""
+        try:
+            return await self._catalog_page({}, limit, cursor)
+        except ValueError:
+            raise
+        except Exception as e:
+            logger.error(f"Error listing the catalog: {e}")
+            return [], None
+
+    async def _files_by_ids(self, ids: List[str], projection: Optional[dict] = None) -> List[dict]:
+        """The file documents of ids in the same order, files deleted meanwhile are skipped."""
+        docs = await self.files_col.find({"_id": {"$in": [ObjectId(i) for i in ids]}}, projection).to_list(length=len(ids))
+        by_id = {str(doc["_id"]): doc for doc in docs}
+        return [by_id[i] for i in ids if i in by_id]
+
+    async def _ranked_page(self, query: str, limit: int, cursor: Optional[str]) -> Tuple[List[dict], Optional[str]]:
+        offset = 0
+        if cursor:
+            offset = cursor[len(RANK_CURSOR):]
+            if not search_index.ready or not offset.isdigit():
+                raise ValueError(f"Invalid cursor: {cursor}")
+            offset = int(offset)
+        ids, total = await search_index.search(query, limit=limit, offset=offset)
+        next_cursor = f"{RANK_CURSOR}{offset + limit}" if offset + limit < total else None
+        return await self._files_by_ids(ids, {"file_name": 1, "time": 1}), next_cursor
+
+    async def search_catalog(self, query: str, limit: int = 30, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Returns a page of the files matching the query and the cursor of the next page, ranked
+        by the search index once it is loaded and newest first from a scan before. A search
+        keeps paging the way it started: ranked cursors are `rank:<offset>`, scan cursors
+        `time:_id`. Raises ValueError for a bad cursor.
+        """
+        regex = ".*".join(re.escape(w) for w in query.lower().split())
+        try:
+            ranked = cursor.startswith(RANK_CURSOR) if cursor else search_index.ready
+            if ranked:
+                return await self._ranked_page(query, limit, cursor)
+            return await self._catalog_page({"file_name": {"$regex": regex, "$options": "i"}}, limit, cursor)
+        except ValueError:
+            raise
+        except Exception as e:
+            logger.error(f"Error searching the catalog for '{query}': {e}")
+            return [], None
+
     async def get_file(self, file_id: str):
         try:
             file_info = await self.files_col.find_one({"_id": ObjectId(file_id)})
@@ -197,22 +392,37 @@ class Database:
 
     async def delete_one_file(self, file_id: str):
         try:
-            await self.files_col.delete_one({"_id": ObjectId(file_id)})
+            result = await self.files_col.delete_one({"_id": ObjectId(file_id)})
             logger.info(f"File {file_id} deleted successfully.")
+            if result.deleted_count:
+                self._notify("delete", {"_id": ObjectId(file_id)})
         except InvalidId:
             logger.warning(f"Attempted to delete with invalid file ID: {file_id}")
         except Exception as e:
             logger.error(f"Error deleting file {file_id}: {e}")
 
-    async def update_file_ids(self, file_id: str, file_ids: dict):
+    async def update_file_ids(self, file_id: str, file_ids: dict, log_msg_id: Optional[int] = None):
+        """Stores the file_id of every client and the BIN_CHANNEL message they were resolved from."""
+        update = {"file_ids": file_ids}
+        if log_msg_id is not None:
+            update["log_msg_id"] = log_msg_id
         try:
-            await self.files_col.update_one({"_id": ObjectId(file_id)}, {"$set": {"file_ids": file_ids}})
+            await self.files_col.update_one({"_id": ObjectId(file_id)}, {"$set": update})
             logger.info(f"File IDs updated for file {file_id}.")
         except InvalidId:
             logger.warning(f"Attempted to update with invalid file ID: {file_id}")
         except Exception as e:
             logger.error(f"Error updating file IDs for file {file_id}: {e}")
 
+    async def update_container_index(self, file_id: str, index: dict):
+        try:
+            await self.files_col.update_one({"_id": ObjectId(file_id)}, {"$set": {"container_index": index}})
+            logger.info(f"Container index stored for file {file_id}.")
+        except InvalidId:
+            logger.warning(f"Attempted to update with invalid file ID: {file_id}")
+        except Exception as e:
+            logger.error(f"Error storing container index for file {file_id}: {e}")
+
     async def total_files(self, user_id: int = None) -> int:
         try:
             if user_id:
@@ -239,3 +449,7 @@ class Database:
         except Exception as e:
             logger.error(f"Error checking link availability for user {user_id}: {e}")
             return False
+
+
+# keep the search index in sync with every Database instance of the process
+Database.add_change_listener(search_index.on_change)
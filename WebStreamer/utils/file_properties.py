@@ -1,46 +1,175 @@
 # This file is a part of FileStreamBot
 
 from __future__ import annotations
+import asyncio
 import logging
 from datetime import datetime
 from pyrogram import Client
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional
 from pyrogram.types import Message
 from pyrogram.file_id import FileId
 from WebStreamer.bot import StreamBot
 from WebStreamer.utils.database import Database
+from WebStreamer.utils.lru_cache import TTLCache
 from WebStreamer.vars import Var
 db = Database(Var.DATABASE_URL, Var.SESSION_NAME)
 
+# file documents by database id, shared by every client
+file_records = TTLCache(Var.FILE_CACHE_SIZE, Var.FILE_CACHE_TTL)
+Database.add_change_listener(lambda event, doc: event == "delete" and file_records.pop(str(doc["_id"])))
+# database id -> task resolving the file ids of the multi clients in the background
+resolving: Dict[str, asyncio.Task] = {}
+MAX_BATCH = 200  # message ids Telegram accepts in one get_messages call
+
+
+class MessageBatcher:
+    def __init__(self, client: Client):
+        """Collects the BIN_CHANNEL messages a client is asked for during FILE_ID_BATCH_WINDOW
+        and fetches them with a single get_messages call.
+        attributes:
+            pending: message id -> futures of the callers waiting for it.
+            flusher: the task fetching the pending messages once the window is over.
+        """
+        self.client = client
+        self.pending: Dict[int, List[asyncio.Future]] = {}
+        self.flusher: Optional[asyncio.Task] = None
+
+    async def get(self, msg_id: int) -> Optional[Message]:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(msg_id, []).append(future)
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self.flush())
+        return await future
+
+    async def flush(self) -> None:
+        await asyncio.sleep(Var.FILE_ID_BATCH_WINDOW)
+        pending, self.pending, self.flusher = self.pending, {}, None
+        msg_ids = list(pending)
+        for i in range(0, len(msg_ids), MAX_BATCH):
+            batch = msg_ids[i:i + MAX_BATCH]
+            try:
+                messages = await self.client.get_messages(Var.BIN_CHANNEL, batch)
+                results = dict(zip(batch, messages))
+            except Exception as e:
+                for msg_id in batch:
+                    for future in pending[msg_id]:
+                        if not future.done():
+                            future.set_exception(e)
+                continue
+            for msg_id in batch:
+                for future in pending[msg_id]:
+                    if not future.done():
+                        future.set_result(results.get(msg_id))
+
+
+batchers: Dict[Client, MessageBatcher] = {}
+
+def get_batcher(client: Client) -> MessageBatcher:
+    batcher = batchers.get(client)
+    if batcher is None:
+        batcher = batchers[client] = MessageBatcher(client)
+    return batcher
+
+async def resolve_file_id(client: Client, msg_id: int) -> str:
+    """The file_id of the media of a BIN_CHANNEL message as seen by the client.
+    Raises asyncio.TimeoutError after FILE_ID_TIMEOUT seconds."""
+    msg = await asyncio.wait_for(get_batcher(client).get(msg_id), Var.FILE_ID_TIMEOUT)
+    media = get_media_from_message(msg)
+    return getattr(media, "file_id", "")
+
+async def get_file_record(db_id: str) -> dict:
+    """Returns the file document, from the cache when possible. Raises FIleNotFound."""
+    return await file_records.get_or_load(str(db_id), lambda: db.get_file(db_id))
+
 async def get_file_ids(client: Client | bool, db_id: str, multi_clients) -> Optional[FileId]:
     logging.debug("Starting of get_file_ids")
-    file_info = await db.get_file(db_id)
+    file_info = await get_file_record(db_id)
     if (not "file_ids" in file_info) or not client:
         logging.debug("Storing file_id of all clients in DB")
-        log_msg=await send_file(StreamBot, file_info['file_id'])
-        await db.update_file_ids(db_id, await update_file_id(log_msg.id, multi_clients))
-        logging.debug("Stored file_id of all clients in DB")
+        await store_file_ids(db_id, multi_clients)
         if not client:
             return
-        file_info = await db.get_file(db_id)
 
     file_id_info=file_info.setdefault("file_ids", {})
+    task = resolving.get(str(db_id))
+    if not str(client.id) in file_id_info and task is not None:
+        # the ids of the multi clients are still being resolved in the background
+        await asyncio.wait([task])
     if not str(client.id) in file_id_info:
         logging.debug("Storing file_id in DB")
-        log_msg=await send_file(StreamBot, file_info['file_id'])
-        msg=await client.get_messages(Var.BIN_CHANNEL,log_msg.id)
-        media = get_media_from_message(msg)
-        file_id_info[str(client.id)]=getattr(media, "file_id", "")
-        await db.update_file_ids(db_id, file_id_info)
+        file_id_info[str(client.id)]=await resolve_from_bin(client, file_info)
+        await db.update_file_ids(db_id, file_id_info, file_info.get("log_msg_id"))
         logging.debug("Stored file_id in DB")
 
     logging.debug("Middle of get_file_ids")
-    file_id = FileId.decode(file_id_info[str(client.id)])
+    file_id = decode_file_id(file_info, file_id_info[str(client.id)])
+    logging.debug("Ending of get_file_ids")
+    return file_id
+
+async def refresh_file_id(client: Client, db_id: str) -> FileId:
+    """Resolves a new file_id for the client once the file reference of the stored one expired."""
+    file_info = await get_file_record(db_id)
+    file_id_info=file_info.setdefault("file_ids", {})
+    file_id_info[str(client.id)]=await resolve_from_bin(client, file_info)
+    await db.update_file_ids(db_id, file_id_info, file_info.get("log_msg_id"))
+    logging.info(f"Refreshed file reference of {db_id} for client {client.id}")
+    return decode_file_id(file_info, file_id_info[str(client.id)])
+
+async def resolve_from_bin(client: Client, file_info: dict) -> str:
+    """
+    Returns a fresh file_id of the client read from the BIN_CHANNEL copy of the file,
+    the file is only copied again when the stored copy can't be read.
+    """
+    msg_id = file_info.get("log_msg_id")
+    if msg_id is not None:
+        try:
+            file_id = await resolve_file_id(client, msg_id)
+            if file_id:
+                return file_id
+        except Exception as e:
+            logging.warning(f"Failed reading message {msg_id} of BIN_CHANNEL with client {client.id}: {e!r}")
+    log_msg=await send_file(StreamBot, file_info['file_id'])
+    file_info["log_msg_id"] = log_msg.id
+    return await resolve_file_id(client, log_msg.id)
+
+async def store_file_ids(db_id: str, multi_clients) -> None:
+    """
+    Copies the file to BIN_CHANNEL and stores the file_id of StreamBot, which comes with
+    the copied message. The ids of the multi clients are resolved in the background.
+    """
+    file_info = await get_file_record(db_id)
+    log_msg=await send_file(StreamBot, file_info['file_id'])
+    file_id_info=file_info.setdefault("file_ids", {})
+    file_id_info[str(StreamBot.id)]=getattr(get_media_from_message(log_msg), "file_id", "")
+    file_info["log_msg_id"] = log_msg.id
+    await db.update_file_ids(db_id, file_id_info, log_msg.id)
+    clients = {client_id: client for client_id, client in multi_clients.items() if client is not StreamBot}
+    if clients:
+        db_id = str(db_id)
+        task = resolving[db_id] = asyncio.create_task(fill_file_ids(db_id, file_id_info, log_msg.id, clients))
+        task.add_done_callback(lambda _: resolving.pop(db_id, None))
+
+async def fill_file_ids(db_id: str, file_id_info: dict, msg_id: int, multi_clients) -> None:
+    try:
+        file_id_info.update(await update_file_id(msg_id, multi_clients))
+        await db.update_file_ids(db_id, file_id_info)
+        logging.debug(f"Stored file_id of {len(file_id_info)} clients for {db_id}")
+    except Exception:
+        logging.error(f"Failed storing the file ids of {db_id}", exc_info=True)
+
+async def store_container_index(db_id: str, index: dict) -> None:
+    """Keeps the parsed container index in the file document and its cached copy."""
+    file_info = await get_file_record(db_id)
+    file_info["container_index"] = index
+    await db.update_container_index(db_id, index)
+
+def decode_file_id(file_info: dict, encoded: str) -> FileId:
+    file_id = FileId.decode(encoded)
     setattr(file_id, "file_size", file_info['file_size'])
     setattr(file_id, "mime_type", file_info['mime_type'])
     setattr(file_id, "file_name", file_info['file_name'])
     setattr(file_id, "unique_id", file_info['file_unique_id'])
-    logging.debug("Ending of get_file_ids")
+    setattr(file_id, "db_id", str(file_info['_id']))
     return file_id
 
 def get_media_from_message(message: "Message") -> Any:
@@ -107,11 +236,16 @@ def get_file_info(message):
         }
 
 async def update_file_id(msg_id, multi_clients):
+    """Resolves the file_id of every client at once, clients failing or timing out are
+    left out and resolved again when they first stream the file."""
+    clients = list(multi_clients.values())
+    results = await asyncio.gather(*(resolve_file_id(client, msg_id) for client in clients), return_exceptions=True)
     file_ids={}
-    for client_id, client in multi_clients.items():
-        log_msg=await client.get_messages(Var.BIN_CHANNEL, msg_id)
-        media = get_media_from_message(log_msg)
-        file_ids[str(client.id)]=getattr(media, "file_id", "")
+    for client, result in zip(clients, results):
+        if isinstance(result, BaseException):
+            logging.warning(f"Failed resolving file_id of message {msg_id} for client {client.id}: {result!r}")
+            continue
+        file_ids[str(client.id)]=result
 
     return file_ids
 
@@ -0,0 +1,118 @@
+# This file is a part of FileStreamBot
+
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class TTLCache:
+    def __init__(
+        self, maxsize: int, ttl: float, max_bytes: Optional[int] = None, sizeof: Callable[[Any], int] = len
+    ):
+        """A size bounded LRU cache whose entries also expire after ttl seconds.
+        attributes:
+            maxsize: maximum number of entries, the least recently used one is evicted first.
+            ttl: seconds an entry stays valid.
+            max_bytes: optional budget of the sum of sizeof(value), values larger than
+                the whole budget are not stored.
+            entries: key -> (expiry time, value, size) in LRU order.
+
+        get_or_load() runs a single loader per missing key, concurrent callers wait for it
+        instead of all hitting the backend at once. pop() and clear() detach the loads in
+        flight, their results are not stored.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.loading: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[0] < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the value without touching the LRU order or the stats.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return default
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        self._remove(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value, size)
+        self.bytes += size
+        while len(self.entries) > self.maxsize or self.max_bytes is not None and self.bytes > self.max_bytes:
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def _remove(self, key: Hashable) -> Optional[tuple]:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+        return entry
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        self.loading.pop(key, None)
+        entry = self._remove(key)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self.loading.clear()
+        self.entries.clear()
+        self.bytes = 0
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is not sentinel:
+            return value
+        future = self.loading.get(key)
+        if future is None:
+            future = self.loading[key] = asyncio.ensure_future(loader())
+            future.add_done_callback(lambda f: self._loaded(key, f))
+        return await asyncio.shield(future)
+
+    def _loaded(self, key: Hashable, future: asyncio.Future) -> None:
+        if self.loading.get(key) is not future:
+            # invalidated while loading, the result may be stale
+            return
+        del self.loading[key]
+        if not future.cancelled() and future.exception() is None:
+            self.set(key, future.result())
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            **({"bytes": self.bytes, "max_bytes": self.max_bytes} if self.max_bytes is not None else {}),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,184 @@
+# This file is a part of FileStreamBot
+
+import time
+import bisect
+from typing import Callable, Dict, Iterator, List, Tuple
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    kind = ""
+    child_class = CounterChild
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        """A metric family in the Prometheus text format.
+        attributes:
+            name: the metric name.
+            documentation: the HELP line.
+            labelnames: the label names, the values are given to labels().
+            children: the child holding the value of each label combination.
+
+        Callers bind the children they update once with labels() and keep them, so
+        updating a metric on the streaming path is a plain attribute increment.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.children: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.append(self)
+
+    def new_child(self):
+        return self.child_class()
+
+    def labels(self, *values) -> object:
+        key = tuple(str(v) for v in values)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self.new_child()
+        return child
+
+    def label_string(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{n}="{v}"' for n, v in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> Iterator[str]:
+        for key, child in list(self.children.items()):
+            yield f"{self.name}{self.label_string(key)} {child.value}"
+
+    def render(self) -> str:
+        return "\n".join([
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+            *self.samples(),
+        ])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+    child_class = GaugeChild
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def samples(self) -> Iterator[str]:
+        for key, child in list(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                yield f"{self.name}_bucket{self.label_string(key, le)} {cumulative}"
+            yield f"{self.name}_sum{self.label_string(key)} {child.sum}"
+            yield f"{self.name}_count{self.label_string(key)} {child.count}"
+
+
+class CallbackMetric(Metric):
+    """A metric read from counters that already exist elsewhere when /metrics is scraped,
+    collect() returns (label values, value) pairs."""
+
+    def __init__(self, name: str, documentation: str, kind: str, collect: Callable[[], List[tuple]], labelnames=()):
+        self.kind = kind
+        self.collect = collect
+        super().__init__(name, documentation, labelnames)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.collect():
+            yield f"{self.name}{self.label_string(tuple(str(v) for v in key))} {value}"
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every command sent to MongoDB by the clients it is registered on."""
+
+    def __init__(self):
+        self.pending: Dict[int, float] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        self.pending[event.request_id] = time.perf_counter()
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self.finished(event, "success")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self.finished(event, "failure")
+
+    def finished(self, event, outcome: str) -> None:
+        start = self.pending.pop(event.request_id, None)
+        if start is not None:
+            MONGO_COMMAND_SECONDS.labels(event.command_name, outcome).observe(time.perf_counter() - start)
+
+
+REGISTRY: List[Metric] = []
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+GETFILE_SECONDS = Histogram(
+    "filestream_getfile_seconds", "Latency of upload.GetFile requests.", ("client", "dc")
+)
+CLIENT_BYTES = Counter(
+    "filestream_client_bytes_total", "Bytes downloaded from Telegram per client.", ("client",)
+)
+FLOOD_WAITS = Counter(
+    "filestream_flood_waits_total", "FloodWait errors received per client.", ("client",)
+)
+SENT_BYTES = Counter("filestream_sent_bytes_total", "Bytes written to download responses.").labels()
+STREAMS = Counter("filestream_streams_total", "Finished downloads by outcome.", ("outcome",))
+TTFB_SECONDS = Histogram(
+    "filestream_time_to_first_byte_seconds", "Time from opening a download to its first written byte."
+).labels()
+MONGO_COMMAND_SECONDS = Histogram(
+    "filestream_mongo_command_seconds", "Latency of MongoDB commands.", ("command", "outcome")
+)
+mongo_listener = MongoCommandListener()
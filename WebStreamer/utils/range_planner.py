@@ -0,0 +1,39 @@
+# This file is a part of FileStreamBot
+
+from typing import Dict, Tuple
+from .chunk_cache import CHUNK_SIZE
+
+# upload.getFile wants offset and limit divisible by 4 KiB, 1 MiB divisible by limit
+# and no request crossing a 1 MiB boundary, so limits are powers of two from 4 KiB to 1 MiB
+MIN_LIMIT = 4 * 1024
+
+# requested_bytes is counted when a range is planned, fetched_bytes and wasted_bytes
+# when upload.getFile returns, bytes dropped from a part no cache keeps are wasted
+range_stats: Dict[str, int] = {
+    "requested_bytes": 0,
+    "fetched_bytes": 0,
+    "wasted_bytes": 0,
+}
+
+
+def plan_range(from_b: int, to_b: int, whole_parts: bool = False) -> Tuple[int, int, int, int, int]:
+    """
+    Returns (offset, first_part_cut, last_part_cut, part_count, chunk_size) to fetch the
+    inclusive byte range from_b..to_b. Ranges shorter than a 1 MiB part use the smallest
+    limit that covers them in at most two requests, longer ranges keep 1 MiB parts.
+    whole_parts keeps 1 MiB parts for short ranges too, so the parts can be cached.
+    """
+    length = to_b - from_b + 1
+    chunk_size = CHUNK_SIZE
+    if length < CHUNK_SIZE and not whole_parts:
+        chunk_size = MIN_LIMIT
+        while chunk_size < length:
+            chunk_size *= 2
+
+    offset = from_b - (from_b % chunk_size)
+    first_part_cut = from_b - offset
+    last_part_cut = to_b % chunk_size + 1
+    part_count = to_b // chunk_size - offset // chunk_size + 1
+
+    range_stats["requested_bytes"] += length
+    return offset, first_part_cut, last_part_cut, part_count, chunk_size
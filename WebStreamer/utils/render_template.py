@@ -1,19 +1,39 @@
 # This file is a part of FileStreamBot
 
-import aiohttp
-import aiofiles
+import os
 import urllib.parse
 from WebStreamer.vars import Var
 from WebStreamer.utils.database import Database
+from WebStreamer.utils.file_properties import get_file_record
 from WebStreamer.utils.human_readable import humanbytes
+from WebStreamer.utils.lru_cache import TTLCache
 
-db = Database(Var.DATABASE_URL, Var.SESSION_NAME)
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'template')
+
+def load_template(name: str) -> str:
+    with open(os.path.join(TEMPLATE_DIR, name)) as template_file:
+        return template_file.read()
+
+# read once at startup, req.html gets its 'tag' placeholder filled per media type
+_req_template = load_template('req.html')
+TEMPLATES = {
+    'video': _req_template.replace('tag', 'video'),
+    'audio': _req_template.replace('tag', 'audio'),
+    None: load_template('dl.html'),
+}
+
+# rendered pages by database id, dropped when the file is deleted
+page_cache = TTLCache(Var.FILE_CACHE_SIZE, Var.FILE_CACHE_TTL)
+Database.add_change_listener(lambda event, doc: event == "delete" and page_cache.pop(str(doc["_id"])))
 
 async def render_page(db_id):
+    return await page_cache.get_or_load(str(db_id), lambda: generate_page(db_id))
+
+async def generate_page(db_id):
     # Fetch file info from database
-    file_data = await db.get_file(db_id)
+    file_data = await get_file_record(db_id)
     mime_main_type = file_data['mime_type'].split('/')[0].strip()
-    
+
     # Properly encode filename for URL
     encoded_file_name = urllib.parse.quote(file_data['file_name'])
 
@@ -23,30 +43,18 @@ async def render_page(db_id):
     # Title for the page
     if mime_main_type == 'video':
         heading = f"Watch {file_data['file_name']}"
-        template_path = 'WebStreamer/template/req.html'
         media_tag = 'video'
+        if Var.FASTSTART:
+            src += "?faststart=1"
     elif mime_main_type == 'audio':
         heading = f"Listen {file_data['file_name']}"
-        template_path = 'WebStreamer/template/req.html'
         media_tag = 'audio'
     else:
         heading = f"Download {file_data['file_name']}"
-        template_path = 'WebStreamer/template/dl.html'
         media_tag = None
 
-    # Load and fill the template
-    async with aiofiles.open(template_path) as template_file:
-        template_content = await template_file.read()
-        
-        if media_tag:
-            # req.html: Replace 'tag' placeholder with video/audio
-            template_content = template_content.replace('tag', media_tag)
-            html = template_content % (heading, file_data['file_name'], src)
-        else:
-            # dl.html: Add size using HEAD request
-            async with aiohttp.ClientSession() as session:
-                async with session.head(src) as response:
-                    file_size = humanbytes(int(response.headers.get('Content-Length', 0)))
-                    html = template_content % (heading, file_data['file_name'], src, file_size)
-
-    return html
+    if media_tag:
+        return TEMPLATES[media_tag] % (heading, file_data['file_name'], src)
+    # dl.html: the size comes from the stored file record
+    file_size = humanbytes(int(file_data.get('file_size') or 0))
+    return TEMPLATES[None] % (heading, file_data['file_name'], src, file_size)
@@ -0,0 +1,269 @@
+# This file is a part of FileStreamBot
+
+import re
+import time
+import heapq
+import asyncio
+import logging
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+TOKEN_RE = re.compile(r"[^\W_]+")
+FUZZY_GRAMS = 8  # rarest query trigrams counted when no file contains every query word
+FUZZY_MAX_POSTING = 50000  # trigrams in more files than this are too common to rank by
+FUZZY_MIN_RATIO = 0.5
+OFFLOAD_CANDIDATES = 20000  # searches scanning more files than this are scored in a worker thread
+MAX_DISCARD_POSTING = 4096  # longer postings keep the slots of removed files, searches skip them
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.casefold())
+
+
+def normalize(text: str) -> str:
+    return f" {' '.join(tokenize(text))} "
+
+
+def word_grams(word: str) -> Set[str]:
+    """Trigrams of a padded word, as stored in the index."""
+    padded = f" {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def contains(posting: array, slot: int) -> bool:
+    try:
+        i = bisect_left(posting, slot)
+        return i < len(posting) and posting[i] == slot
+    except IndexError:
+        # the posting shrank under a search running in a worker thread
+        return False
+
+
+def discard(posting: array, slot: int) -> None:
+    if len(posting) > MAX_DISCARD_POSTING:
+        return
+    i = bisect_left(posting, slot)
+    if i < len(posting) and posting[i] == slot:
+        del posting[i]
+
+
+def query_grams(token: str) -> Tuple[Set[str], str]:
+    """
+    Returns the trigrams a file must contain to match a query word and the fragment of the
+    normalized name that confirms it: one letter words match whole words, two letter words
+    word prefixes and longer words any substring.
+    """
+    if len(token) == 1:
+        return {f" {token} "}, f" {token} "
+    if len(token) == 2:
+        return {f" {token}"}, f" {token}"
+    return {token[i:i + 3] for i in range(len(token) - 2)}, token
+
+
+class TrigramIndex:
+    def __init__(self):
+        """An in-memory trigram inverted index over the file names of the file collection.
+        attributes:
+            ids / names / users: the file id, normalized name and user id of each slot,
+                ids and names are None once the file is removed.
+            slots: file id -> slot.
+            postings: trigram -> sorted array of the slots of the files whose name contains it,
+                postings too long to shift cheaply keep the slots of removed files.
+            user_slots: user id -> sorted array of the slots of the files of that user.
+            ready: False until build() loaded the whole collection.
+
+        Slots are handed out in increasing order and build() loads the oldest files first,
+        so a higher slot is a newer file and postings stay sorted by only ever appending.
+        A search walks the smallest posting from its newest end, checks the others by
+        bisection and stops once the page is filled with whole word matches.
+        """
+        self.ids: List[Optional[str]] = []
+        self.names: List[Optional[str]] = []
+        self.users = array("q")
+        self.slots: Dict[str, int] = {}
+        self.postings: Dict[str, array] = {}
+        self.user_slots: Dict[int, array] = {}
+        self.ready = False
+        self._removed_while_building: Set[str] = set()
+        self._building = False
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def add(self, doc: dict) -> None:
+        file_id = str(doc["_id"])
+        if self._building and file_id in self._removed_while_building:
+            return
+        self.remove(file_id)
+        normalized = normalize(doc.get("file_name") or "")
+        user_id = doc.get("user_id") or 0
+        slot = len(self.ids)
+        self.ids.append(file_id)
+        self.names.append(normalized)
+        self.users.append(user_id)
+        self.slots[file_id] = slot
+        for gram in self._grams(normalized):
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array("I")
+            posting.append(slot)
+        posting = self.user_slots.get(user_id)
+        if posting is None:
+            posting = self.user_slots[user_id] = array("I")
+        posting.append(slot)
+
+    def remove(self, file_id: str) -> None:
+        slot = self.slots.pop(file_id, None)
+        if slot is None:
+            return
+        normalized = self.names[slot]
+        self.ids[slot] = self.names[slot] = None
+        for gram in self._grams(normalized):
+            posting = self.postings.get(gram)
+            if posting is not None:
+                discard(posting, slot)
+                if not posting:
+                    del self.postings[gram]
+        user_id = self.users[slot]
+        posting = self.user_slots.get(user_id)
+        if posting is not None:
+            discard(posting, slot)
+            if not posting:
+                del self.user_slots[user_id]
+
+    @staticmethod
+    def _grams(normalized: str) -> Set[str]:
+        grams = set()
+        for word in normalized.split():
+            grams |= word_grams(word)
+        return grams
+
+    def on_change(self, event: str, doc: dict) -> None:
+        """Database change listener keeping the index in sync with the file collection."""
+        if not (self.ready or self._building):
+            return
+        if event == "add":
+            self.add(doc)
+        elif event == "delete":
+            if self._building:
+                self._removed_while_building.add(str(doc["_id"]))
+            self.remove(str(doc["_id"]))
+
+    async def build(self, files_col) -> None:
+        """
+        Loads every file of the collection oldest first, changes made meanwhile are applied as they come.
+        """
+        start = time.monotonic()
+        self._building = True
+        try:
+            cursor = files_col.find({}, {"file_name": 1, "user_id": 1}).sort([("time", 1), ("_id", 1)])
+            async for doc in cursor:
+                self.add(doc)
+        finally:
+            self._building = False
+            self._removed_while_building.clear()
+        self.ready = True
+        logging.info(f"Search index built with {len(self)} files in {time.monotonic() - start:.1f}s")
+
+    async def search(
+        self, query: str, user_id: Optional[int] = None, limit: int = 30, offset: int = 0
+    ) -> Tuple[List[str], int]:
+        """
+        Returns the ids of a page of the files matching every word of the query, best first,
+        and the number of matches. Whole word matches rank above word prefixes above
+        substrings, newer files first on ties. When no file matches every word, files sharing
+        most of the rarest trigrams of the query are returned instead. When the page is found
+        before every candidate was scored, the number of matches is an estimate.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return [], 0
+        within = None
+        if user_id is not None:
+            within = self.user_slots.get(user_id)
+            if not within:
+                return [], 0
+
+        wanted = [query_grams(token) for token in tokens]
+        postings = [self.postings.get(gram) for grams, _ in wanted for gram in grams]
+        if within is not None:
+            postings.append(within)
+        scanned = min(len(posting) for posting in postings if posting) if any(postings) else 0
+        if scanned > OFFLOAD_CANDIDATES:
+            slots, total = await asyncio.get_running_loop().run_in_executor(
+                None, self._rank, tokens, wanted, postings, within, offset + limit
+            )
+        else:
+            slots, total = self._rank(tokens, wanted, postings, within, offset + limit)
+        ids = [self.ids[slot] for slot in slots[offset:]]
+        return [file_id for file_id in ids if file_id is not None], total
+
+    def _rank(
+        self, tokens: List[str], wanted: List[Tuple[Set[str], str]], postings: List[Optional[array]],
+        within: Optional[array], count: int,
+    ) -> Tuple[List[int], int]:
+        """Returns the best count slots, best first, and the number of matches."""
+        if not all(postings):
+            return self._fuzzy(set().union(*(grams for grams, _ in wanted)), within, count)
+        postings = sorted(postings, key=len)
+        driver, others = postings[0][:], postings[1:]
+        checks = [(fragment, f" {token} ", f" {token}") for token, (_, fragment) in zip(tokens, wanted)]
+        top = 3 * len(tokens)
+        best: List[int] = []
+        scored: List[Tuple[int, int]] = []
+        for scanned, slot in enumerate(reversed(driver), 1):
+            if others and not all(contains(posting, slot) for posting in others):
+                continue
+            name = self.names[slot]
+            if name is None:
+                continue
+            score = 0
+            for fragment, whole, prefix in checks:
+                if fragment not in name:
+                    break
+                score += 3 if whole in name else 2 if prefix in name else 1
+            else:
+                if score < top:
+                    scored.append((-score, -slot))
+                    continue
+                best.append(slot)
+                if len(best) == count:
+                    matches = len(best) + len(scored)
+                    if scanned == len(driver):
+                        return best, matches
+                    return best, max(matches * len(driver) // scanned, count + 1)
+        if not best and not scored:
+            return self._fuzzy(set().union(*(grams for grams, _ in wanted)), within, count)
+        rest = heapq.nsmallest(count - len(best), scored)
+        return best + [-slot for _, slot in rest], len(best) + len(scored)
+
+    def _fuzzy(self, grams: Set[str], within: Optional[array], count: int) -> Tuple[List[int], int]:
+        postings = sorted(
+            (p for p in (self.postings.get(gram) for gram in grams) if p and len(p) <= FUZZY_MAX_POSTING),
+            key=len,
+        )[:FUZZY_GRAMS]
+        if not postings:
+            return [], 0
+        members = None if within is None else set(within)
+        counts = Counter()
+        for posting in postings:
+            counts.update(posting if members is None else members.intersection(posting))
+        needed = len(postings) * FUZZY_MIN_RATIO
+        names = self.names
+        scored = [
+            (-matched, -slot) for slot, matched in counts.items() if matched >= needed and names[slot] is not None
+        ]
+        return [-slot for _, slot in heapq.nsmallest(count, scored)], len(scored)
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "files": len(self),
+            "trigrams": len(self.postings),
+            "postings": sum(len(posting) for posting in self.postings.values()),
+        }
+
+
+search_index = TrigramIndex()
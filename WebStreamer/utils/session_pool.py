@@ -0,0 +1,188 @@
+# This file is a part of FileStreamBot
+
+import random
+import asyncio
+import logging
+from typing import Dict, Set
+from pyrogram import Client, raw
+from pyrogram.session import Session, Auth
+from pyrogram.errors import AuthBytesInvalid
+from WebStreamer.vars import Var
+
+DROP_GRACE = 60  # seconds a replaced session keeps running for the requests still using it
+
+
+class MediaSessionPool:
+    def __init__(self, client: Client):
+        """Holds the media sessions of a client, one per DC.
+        attributes:
+            client: the client that owns the sessions, they are stored in client.media_sessions.
+            locks: one lock per DC so concurrent requests never build the same session twice.
+            created: number of sessions created by this pool.
+            stopping: the tasks stopping replaced sessions once their grace period is over.
+        """
+        self.client = client
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.created = 0
+        self.stopping: Set[asyncio.Task] = set()
+
+    async def get(self, dc_id: int) -> Session:
+        """
+        Returns the media session for the DC, creating it the first time it's needed.
+        """
+        media_session = self.client.media_sessions.get(dc_id, None)
+        if media_session is not None:
+            logging.debug(f"Using cached media session for DC {dc_id}")
+            return media_session
+
+        lock = self.locks.setdefault(dc_id, asyncio.Lock())
+        async with lock:
+            media_session = self.client.media_sessions.get(dc_id, None)
+            if media_session is None:
+                media_session = await self.create(dc_id)
+                self.client.media_sessions[dc_id] = media_session
+        return media_session
+
+    async def create(self, dc_id: int) -> Session:
+        """
+        Generates the media session for a DC.
+        This is required for getting the bytes from Telegram servers.
+        """
+        client = self.client
+        if dc_id != await client.storage.dc_id():
+            media_session = Session(
+                client,
+                dc_id,
+                await Auth(
+                    client, dc_id, await client.storage.test_mode()
+                ).create(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+
+            for _ in range(6):
+                exported_auth = await client.invoke(
+                    raw.functions.auth.ExportAuthorization(dc_id=dc_id)
+                )
+
+                try:
+                    await media_session.invoke(
+                        raw.functions.auth.ImportAuthorization(
+                            id=exported_auth.id, bytes=exported_auth.bytes
+                        )
+                    )
+                    break
+                except AuthBytesInvalid:
+                    logging.debug(
+                        f"Invalid authorization bytes for DC {dc_id}"
+                    )
+                    continue
+            else:
+                await media_session.stop()
+                raise AuthBytesInvalid
+        else:
+            media_session = Session(
+                client,
+                dc_id,
+                await client.storage.auth_key(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+        self.created += 1
+        logging.debug(f"Created media session for DC {dc_id}")
+        return media_session
+
+    async def drop(self, dc_id: int, media_session: Session) -> None:
+        """
+        Replaces a dead media session, the next get() builds a new one. The old session
+        is only stopped after DROP_GRACE seconds so the requests other streams still run
+        on it can finish. Does nothing if the session was already replaced by another request.
+        """
+        lock = self.locks.setdefault(dc_id, asyncio.Lock())
+        async with lock:
+            if self.client.media_sessions.get(dc_id, None) is not media_session:
+                return
+            del self.client.media_sessions[dc_id]
+        task = asyncio.ensure_future(self.stop_later(dc_id, media_session))
+        self.stopping.add(task)
+        task.add_done_callback(self.stopping.discard)
+
+    @staticmethod
+    async def stop_later(dc_id: int, media_session: Session) -> None:
+        await asyncio.sleep(DROP_GRACE)
+        try:
+            await media_session.stop()
+        except Exception:
+            logging.debug(f"Failed stopping media session for DC {dc_id}", exc_info=True)
+
+    async def recover(self, dc_id: int, media_session: Session) -> Session:
+        """
+        Called after a request on the session timed out. Returns the same session if it
+        still answers a ping, a single slow request doesn't cost every stream of the DC
+        its session, otherwise replaces it with a new one.
+        """
+        if await self.is_alive(media_session):
+            return media_session
+        logging.warning(f"Media session for DC {dc_id} stopped answering, rebuilding it")
+        await self.drop(dc_id, media_session)
+        return await self.get(dc_id)
+
+    @staticmethod
+    async def is_alive(media_session: Session) -> bool:
+        try:
+            await asyncio.wait_for(
+                media_session.invoke(raw.functions.Ping(ping_id=random.randint(0, 2 ** 31))),
+                timeout=Var.SESSION_PROBE_TIMEOUT
+            )
+            return True
+        except Exception:
+            return False
+
+    async def check(self) -> None:
+        """
+        Probes every media session and rebuilds the ones that don't answer.
+        """
+        for dc_id, media_session in list(self.client.media_sessions.items()):
+            if await self.is_alive(media_session):
+                continue
+            logging.warning(f"Media session for DC {dc_id} is dead, rebuilding it")
+            await self.drop(dc_id, media_session)
+            try:
+                await self.get(dc_id)
+            except Exception:
+                logging.error(f"Failed rebuilding media session for DC {dc_id}", exc_info=True)
+
+    async def warm(self) -> None:
+        """
+        Creates the media sessions of every DC ahead of the first request.
+        """
+        dc_ids = range(1, 4) if await self.client.storage.test_mode() else range(1, 6)
+        for dc_id in dc_ids:
+            try:
+                await self.get(dc_id)
+            except Exception:
+                logging.warning(f"Failed warming media session for DC {dc_id}", exc_info=True)
+
+
+session_pools: Dict[Client, MediaSessionPool] = {}
+
+
+def get_session_pool(client: Client) -> MediaSessionPool:
+    pool = session_pools.get(client)
+    if pool is None:
+        pool = session_pools[client] = MediaSessionPool(client)
+    return pool
+
+
+async def warm_media_sessions(clients: dict) -> None:
+    await asyncio.gather(*(get_session_pool(client).warm() for client in clients.values()))
+    logging.info("Media sessions warmed up")
+
+
+async def check_media_sessions(clients: dict) -> None:
+    while True:
+        await asyncio.sleep(Var.SESSION_CHECK_INTERVAL)
+        for client in clients.values():
+            await get_session_pool(client).check()
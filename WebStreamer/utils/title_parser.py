@@ -0,0 +1,150 @@
+# This file is a part of FileStreamBot
+
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+import PTN
+from WebStreamer.parse_worker import parse_many
+from WebStreamer.vars import Var
+from WebStreamer.utils.lru_cache import TTLCache
+from WebStreamer.utils.search_index import tokenize
+
+POOL_THRESHOLD = 64  # uncached titles from which a batch is parsed in the process pool, smaller ones in a thread
+
+# title -> PTN result, results never go stale so entries only leave by LRU eviction.
+# The cached dicts are shared, callers must not modify them.
+parsed_titles = TTLCache(Var.PARSE_CACHE_SIZE, float("inf"))
+parse_stats = {
+    "single_titles": 0,
+    "single_seconds": 0.0,
+    "batch_titles": 0,
+    "batch_seconds": 0.0,
+}
+_pool: Optional[ProcessPoolExecutor] = None
+WORKERS = Var.PARSE_WORKERS or os.cpu_count() or 1
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # forking a process running the motor and pyrogram threads can deadlock the child,
+        # forkserver workers only import the standalone parse_worker module
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["WebStreamer.parse_worker"])
+        _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=context)
+    return _pool
+
+
+def discard_pool(pool: ProcessPoolExecutor) -> None:
+    """Drops a broken pool, the next large batch starts a new one."""
+    global _pool
+    if _pool is pool:
+        _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def parse_in_pool(titles: List[str]) -> List[dict]:
+    pool = get_pool()
+    size = -(-len(titles) // WORKERS)
+    loop = asyncio.get_running_loop()
+    try:
+        chunks = await asyncio.gather(*(
+            loop.run_in_executor(pool, parse_many, titles[i:i + size])
+            for i in range(0, len(titles), size)
+        ))
+    except BrokenProcessPool:
+        discard_pool(pool)
+        raise
+    return [result for chunk in chunks for result in chunk]
+
+
+def timed_parse(title: str) -> tuple:
+    start = time.perf_counter()
+    return PTN.parse(title), time.perf_counter() - start
+
+
+async def parse_title(title: str) -> dict:
+    parsed = parsed_titles.get(title)
+    if parsed is None:
+        parsed, seconds = await asyncio.get_running_loop().run_in_executor(None, timed_parse, title)
+        parse_stats["single_titles"] += 1
+        parse_stats["single_seconds"] += seconds
+        parsed_titles.set(title, parsed)
+    return parsed
+
+
+async def parse_titles(titles: List[str]) -> List[dict]:
+    """
+    Parses a batch of titles, returned in the same order. Cached titles are answered
+    from the memo, duplicates are parsed once, and new titles are parsed off the event
+    loop so it keeps serving streams: in a thread for small batches, split over the
+    process pool for large ones.
+    """
+    results: Dict[str, dict] = {}
+    missing = []
+    for title in dict.fromkeys(titles):
+        parsed = parsed_titles.get(title)
+        if parsed is None:
+            missing.append(title)
+        else:
+            results[title] = parsed
+
+    if missing:
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        if len(missing) < POOL_THRESHOLD:
+            parsed = await loop.run_in_executor(None, parse_many, missing)
+        else:
+            try:
+                parsed = await parse_in_pool(missing)
+            except BrokenProcessPool:
+                logging.error("The title parser pool broke, parsing the batch in a thread", exc_info=True)
+                parsed = await loop.run_in_executor(None, parse_many, missing)
+        seconds = time.perf_counter() - start
+        parse_stats["batch_titles"] += len(missing)
+        parse_stats["batch_seconds"] += seconds
+        logging.debug(f"Parsed {len(missing)} titles in {seconds:.3f}s")
+        for title, result in zip(missing, parsed):
+            parsed_titles.set(title, result)
+            results[title] = result
+    return [results[title] for title in titles]
+
+
+def release_metadata(parsed: dict) -> dict:
+    """
+    The parsed fields stored in the `meta` of a file document. title_key is the lowercased
+    title words for exact lookups, season and episode ranges (S01-S02, E01E02) keep their
+    first value and store the last one in season_to / episode_to, so no indexed field is
+    an array.
+    """
+    meta = {"title_key": " ".join(tokenize(parsed.get("title") or ""))}
+    for field in ("title", "year", "resolution", "quality", "codec"):
+        if parsed.get(field) is not None:
+            meta[field] = parsed[field]
+    for field in ("season", "episode"):
+        value = parsed.get(field)
+        if isinstance(value, list):
+            if not value:
+                continue
+            value, meta[f"{field}_to"] = value[0], value[-1]
+        if value is not None:
+            meta[field] = value
+    return meta
+
+
+def titles_per_second(titles: int, seconds: float) -> Optional[float]:
+    return round(titles / seconds, 1) if seconds else None
+
+
+def stats() -> dict:
+    return {
+        "cache": parsed_titles.stats(),
+        "single_titles_per_second": titles_per_second(parse_stats["single_titles"], parse_stats["single_seconds"]),
+        "batch_titles_per_second": titles_per_second(parse_stats["batch_titles"], parse_stats["batch_seconds"]),
+        **{k: round(v, 3) if isinstance(v, float) else v for k, v in parse_stats.items()},
+    }
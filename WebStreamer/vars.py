@@ -19,6 +19,40 @@ class Var(object):
     PORT = int(environ.get("PORT", 8080))
     BIND_ADDRESS = str(environ.get("WEB_SERVER_BIND_ADDRESS", "0.0.0.0"))
     PING_INTERVAL = int(environ.get("PING_INTERVAL", "1200"))  # 20 minutes
+    PREFETCH_WINDOW = int(environ.get("PREFETCH_WINDOW", "4"))  # GetFile requests in flight per stream
+    FILE_CACHE_SIZE = int(environ.get("FILE_CACHE_SIZE", "10000"))  # cached files / file ids
+    FILE_CACHE_TTL = int(environ.get("FILE_CACHE_TTL", "1800"))  # 30 minutes
+    FILE_ID_BATCH_WINDOW = int(environ.get("FILE_ID_BATCH_WINDOW", "50")) / 1000  # ms, file ids fetched together
+    FILE_ID_TIMEOUT = int(environ.get("FILE_ID_TIMEOUT", "10"))  # seconds a client has to resolve a file id
+    STREAM_BUFFER_SIZE = int(environ.get("STREAM_BUFFER_SIZE", "1024")) * 1024  # KiB buffered per connection
+    MAX_STREAMS = int(environ.get("MAX_STREAMS", "0"))  # open downloads, 0 = unlimited
+    MAX_STREAMS_PER_IP = int(environ.get("MAX_STREAMS_PER_IP", "0"))
+    MAX_STREAMS_PER_FILE = int(environ.get("MAX_STREAMS_PER_FILE", "0"))
+    RATE_LIMIT = int(environ.get("RATE_LIMIT", "0")) * 1024  # KiB/s, 0 = unlimited
+    RATE_LIMIT_PER_IP = int(environ.get("RATE_LIMIT_PER_IP", "0")) * 1024
+    RATE_LIMIT_PER_FILE = int(environ.get("RATE_LIMIT_PER_FILE", "0")) * 1024
+    RETRY_AFTER = int(environ.get("RETRY_AFTER", "10"))  # seconds, sent with 429/503
+    TRUSTED_PROXIES = int(environ.get("TRUSTED_PROXIES", "0"))  # proxy hops whose X-Forwarded-For is trusted
+    CACHE_MAX_AGE = int(environ.get("CACHE_MAX_AGE", "86400"))  # Cache-Control max-age of downloads, 1 day
+    CATALOG_CACHE_TTL = int(environ.get("CATALOG_CACHE_TTL", "30"))  # seconds /latest and /featured are cached
+    PARSE_CACHE_SIZE = int(environ.get("PARSE_CACHE_SIZE", "50000"))  # memoized /parse titles
+    PARSE_WORKERS = int(environ.get("PARSE_WORKERS", "0"))  # processes parsing large batches, 0 = one per CPU
+    PARSE_MAX_BATCH = int(environ.get("PARSE_MAX_BATCH", "10000"))
+    BROADCAST_WORKERS = int(environ.get("BROADCAST_WORKERS", "10"))  # messages being sent at once
+    BROADCAST_RATE = float(environ.get("BROADCAST_RATE", "25"))  # messages/s per client
+    BROADCAST_MULTI_CLIENT = str(environ.get("BROADCAST_MULTI_CLIENT", "0").lower()) in ("1", "true", "t", "yes", "y")
+    BROADCAST_PROGRESS_INTERVAL = int(environ.get("BROADCAST_PROGRESS_INTERVAL", "10"))  # seconds
+    FASTSTART = str(environ.get("FASTSTART", "0").lower()) in ("1", "true", "t", "yes", "y")
+    WARM_MEDIA_SESSIONS = str(environ.get("WARM_MEDIA_SESSIONS", "1").lower()) in ("1", "true", "t", "yes", "y")
+    SESSION_CHECK_INTERVAL = int(environ.get("SESSION_CHECK_INTERVAL", "300"))  # 5 minutes, 0 = disabled
+    SESSION_PROBE_TIMEOUT = int(environ.get("SESSION_PROBE_TIMEOUT", "10"))
+    SCHEDULER = str(environ.get("SCHEDULER", "throughput"))  # least_load or throughput
+    STRIPE_CLIENTS = int(environ.get("STRIPE_CLIENTS", "1"))  # clients sharing one download, 1 = disabled
+    STRIPE_MIN_SIZE = int(environ.get("STRIPE_MIN_SIZE", "64")) * 1024 * 1024  # MiB
+    CACHE_DIR = environ.get("CACHE_DIR", None)  # on-disk part cache, disabled when unset
+    CACHE_SIZE = int(environ.get("CACHE_SIZE", "1024")) * 1024 * 1024  # MiB
+    HOT_CACHE_SIZE = int(environ.get("HOT_CACHE_SIZE", "64")) * 1024 * 1024  # MiB, 0 = disabled
+    HOT_FILE_SIZE = int(environ.get("HOT_FILE_SIZE", "2")) * 1024 * 1024  # files kept whole in memory, MiB
     HAS_SSL = str(environ.get("HAS_SSL", "0").lower()) in ("1", "true", "t", "yes", "y")
     NO_PORT = str(environ.get("NO_PORT", "0").lower()) in ("1", "true", "t", "yes", "y")
     FQDN = str(environ.get("FQDN", BIND_ADDRESS))
@@ -44,4 +78,6 @@ class Var(object):
 
     MODE = environ.get("MODE", "primary")
     SECONDARY = True if MODE.lower() == "secondary" else False
+    # the in-memory search index, secondaries fall back to searching the database
+    SEARCH_INDEX = str(environ.get("SEARCH_INDEX", "0" if SECONDARY else "1").lower()) in ("1", "true", "t", "yes", "y")
     LINK_LIMIT = int(environ.get("LINK_LIMIT")) if "LINK_LIMIT" in environ else None
\ No newline at end of file